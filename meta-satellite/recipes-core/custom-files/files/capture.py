@@ -1,56 +1,482 @@
 #!/usr/bin/env python3
 import os
 import sys
+import gc
+import json
 import time
+import threading
 import subprocess
 from datetime import datetime
 
+# ===== AR2020 capture =====
+AR2020_DEVICE = "/dev/video0"
+AR2020_WIDTH = 5120
+AR2020_HEIGHT = 3840
+AR2020_FORMAT = "BA10"
+# "v4l2": in-process ioctl/mmap backend (v4l2_capture.py), falls back to
+# "v4l2-ctl" (two shell invocations) when the backend fails
+CAPTURE_BACKEND = "v4l2"
+# Buffers queued for a burst, so the driver keeps filling while one is summed
+BURST_BUFFERS = 4
+
+LANE_PATH = "/sys/bus/i2c/devices/2-0070/lane_switch/current_lane"
+SENSOR_PATH = "/sys/bus/i2c/devices/2-0020/sensor_switch/current_sensor"
+USB_DEVICE = "/dev/video1"
+
+# ===== Readiness polling =====
+# The lane/sensor sysfs stores update current_* synchronously, so reading
+# them back says nothing about the sensor. Right after the switch (plus an
+# optional AR2020_MIN_SETTLE floor, 0 = none) first_frame() does STREAMON
+# and waits in DQBUF for the first non-error frame, up to
+# AR2020_READY_TIMEOUT after the switch (v4l2-ctl waited 5 s). Only a failed
+# ioctl or an error-flagged buffer restarts the stream, with backoff from
+# READY_POLL_MIN up to READY_POLL_MAX. Switch -> first frame times (from the
+# buffer timestamp) go to SETTLE_LOG.
+READY_POLL_MIN = 0.01
+READY_POLL_MAX = 0.2
+AR2020_MIN_SETTLE = 0.0
+AR2020_READY_TIMEOUT = 5.0
+USB_READY_TIMEOUT = 5.0      # /dev/video1 appearing after the USB power-up
+SETTLE_LOG = "/data/.a55_src/settle_times.json"
+
+# ===== Daily direct decode =====
+# True: daily AR2020 frames are decoded by raw_imx93 in this process straight
+# from the V4L2 buffer and zipped into Daily/, no raw round trip through
+# /data/.a55_src/tmp and file_watcher (v4l2 backend only)
+DAILY_DIRECT = False
+DIRECT_WORK_DIR = "/tmp/capture_direct"   # JPEGs before zipping (tmpfs)
+DAILY_RAW_DIR = None   # e.g. "/data/Daily/Raw": also keep the raw, written alongside the decode
+HANDOFF_DIR = "/data/.a55_src/tmp"   # file_watcher input (raw frames to decode)
+
+class FrameUnavailable(RuntimeError):
+    """capture_daily_direct() got no frame from the sensor, a fresh capture may be tried."""
+
 def run_cmd(cmd, timeout=5):
-    """Chạy lệnh shell với timeout"""
+    """Chạy lệnh shell với timeout, trả về True nếu thành công"""
     try:
         print(f"[CMD] {cmd}")
         subprocess.run(cmd, shell=True, check=True, timeout=timeout)
+        return True
     except subprocess.TimeoutExpired:
         print(f"[ERROR] Command timeout after {timeout}s: {cmd}")
     except subprocess.CalledProcessError as e:
         print(f"[ERROR] Command failed: {e}")
+    return False
 
-def capture_ar2020(cam_id, mode):
-    """Chụp ảnh từ camera AR2020 (0–3)"""
-    # === SWITCH SENSOR/PCA bằng sysfs ===
+def wait_until(ready, timeout, poll_min=READY_POLL_MIN, poll_max=READY_POLL_MAX):
+    """
+    Poll ready() with doubling backoff until it returns True or `timeout`
+    seconds passed. Returns (ok, elapsed seconds).
+    """
+    t0 = time.monotonic()
+    delay = poll_min
+    while True:
+        try:
+            if ready():
+                return True, time.monotonic() - t0
+        except OSError:
+            pass
+        left = timeout - (time.monotonic() - t0)
+        if left <= 0:
+            return False, time.monotonic() - t0
+        time.sleep(min(delay, left))
+        delay = min(delay * 2, poll_max)
+
+def video_node_ready(device):
+    """ready() of wait_until: the video node exists and can be opened."""
+    def ready():
+        fd = os.open(device, os.O_RDWR | os.O_NONBLOCK)
+        os.close(fd)
+        return True
+    return ready
+
+def record_settle(camera, stage, elapsed, ok, path=None):
+    """Add one measured settle time to the per-camera statistics in SETTLE_LOG."""
+    path = path or SETTLE_LOG
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        data = {}
+    st = data.setdefault(str(camera), {}).setdefault(stage, {
+        'count': 0, 'timeouts': 0, 'min': None, 'max': None, 'mean': 0.0, 'last': None})
+    st['count'] += 1
+    st['timeouts'] += 0 if ok else 1
+    st['last'] = round(elapsed, 4)
+    st['min'] = st['last'] if st['min'] is None else min(st['min'], st['last'])
+    st['max'] = st['last'] if st['max'] is None else max(st['max'], st['last'])
+    st['mean'] = round(st['mean'] + (elapsed - st['mean']) / st['count'], 4)
+    tmp = path + ".tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp, "w") as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"[WARN] Cannot write settle log {path}: {e}")
+
+def wait_ready(camera, stage, ready, timeout):
+    """wait_until() + record_settle() + log line, returns True when ready."""
+    ok, elapsed = wait_until(ready, timeout)
+    record_settle(camera, stage, elapsed, ok)
+    if ok:
+        print(f"[INFO] {camera} {stage} ready after {elapsed:.3f}s")
+    else:
+        print(f"[WARN] {camera} {stage} not ready after {elapsed:.3f}s, continuing")
+    return ok
+
+def first_frame(cam, camera, t_switch, count=None):
+    """
+    STREAMON and wait in DQBUF for the first non-error frame of the sensor,
+    until AR2020_READY_TIMEOUT after t_switch; a failed ioctl or an
+    error-flagged buffer restarts the stream after a short backoff. Records
+    switch -> first frame in SETTLE_LOG. Returns the Frame (still streaming,
+    give it back with cam.requeue()), raises V4l2Error at the ceiling.
+    """
+    from v4l2_capture import (V4l2Error, FrameTimeout, DEFAULT_BUFFERS, V4L2_BUF_FLAG_ERROR,
+                              V4L2_BUF_FLAG_TIMESTAMP_MASK, V4L2_BUF_FLAG_TIMESTAMP_MONOTONIC)
+
+    deadline = t_switch + AR2020_READY_TIMEOUT
+    delay = READY_POLL_MIN
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            cam.start(count or DEFAULT_BUFFERS)
+            frame = cam.dequeue(timeout=max(deadline - time.monotonic(), READY_POLL_MIN))
+            if frame.flags & V4L2_BUF_FLAG_ERROR:
+                cam.requeue(frame)
+                raise V4l2Error(f"{camera}: error-flagged buffer (sequence {frame.sequence})")
+        except V4l2Error as e:
+            cam.stop()
+            elapsed = time.monotonic() - t_switch
+            if isinstance(e, FrameTimeout) or time.monotonic() + delay >= deadline:
+                record_settle(camera, "first_frame", elapsed, False)
+                raise V4l2Error(f"{camera}: no valid frame {elapsed:.3f}s after the switch "
+                                f"({attempts} attempts): {e}")
+            time.sleep(delay)
+            delay = min(delay * 2, READY_POLL_MAX)
+            continue
+        now = time.monotonic()
+        # V4L2 monotonic timestamps share CLOCK_MONOTONIC with time.monotonic()
+        if ((frame.flags & V4L2_BUF_FLAG_TIMESTAMP_MASK) == V4L2_BUF_FLAG_TIMESTAMP_MONOTONIC
+                and t_switch <= frame.timestamp <= now):
+            elapsed = frame.timestamp - t_switch
+        else:
+            elapsed = now - t_switch
+        record_settle(camera, "first_frame", elapsed, True)
+        print(f"[INFO] {camera} first frame after {elapsed:.3f}s ({attempts} attempt(s))")
+        return frame
+
+def grab_frame(cam, filepath, burst=1, camera=None, t_switch=None):
+    """
+    One frame from an open, formatted V4l2Capture, written straight from the
+    mapped buffer; burst > 1 writes the mean of that many consecutive
+    frames instead. The first frame is awaited with first_frame(), t_switch
+    being the monotonic time of the sensor switch. Streaming is stopped
+    again afterwards (the format is kept). The frame goes to a hidden temp
+    name first so file_watcher never sees a partial file.
+    """
+    from v4l2_capture import write_buffer
+
+    tmp_path = os.path.join(os.path.dirname(filepath), "." + os.path.basename(filepath) + ".part")
+    t0 = time.perf_counter()
+    try:
+        frame = first_frame(cam, camera, time.monotonic() if t_switch is None else t_switch,
+                            BURST_BUFFERS if burst > 1 else None)
+        if burst > 1:
+            cam.requeue(frame)
+            info = cam.capture_stack(tmp_path, burst)
+        else:
+            try:
+                info = {'bytes': write_buffer(tmp_path, frame.data), 'sequence': frame.sequence,
+                        'timestamp': frame.timestamp}
+            finally:
+                cam.requeue(frame)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        cam.stop()
+    os.replace(tmp_path, filepath)
+    if burst > 1:
+        span = info['timestamps'][-1] - info['timestamps'][0]
+        print(f"[INFO] Burst of {burst} frames #{info['sequences'][0]}-#{info['sequences'][-1]} "
+              f"over {span:.3f}s ({info['dropped']} dropped), stacked in {time.perf_counter() - t0:.3f}s")
+    else:
+        print(f"[INFO] Frame #{info['sequence']} ts={info['timestamp']:.6f} "
+              f"{info['bytes']} B in {time.perf_counter() - t0:.3f}s")
+
+def grab_v4l2(filepath, burst=1, camera=None, t_switch=None):
+    """One AR2020 frame (or burst mean) through the mmap backend, see grab_frame()."""
+    from v4l2_capture import V4l2Capture
+
+    with V4l2Capture(AR2020_DEVICE) as cam:
+        cam.set_format(AR2020_WIDTH, AR2020_HEIGHT, AR2020_FORMAT)
+        grab_frame(cam, filepath, burst, camera, t_switch)
+
+def _persist_raw(path, data):
+    """Write data to path through a hidden temp name (file_watcher-safe), True on success."""
+    from v4l2_capture import write_buffer
+
+    tmp_path = os.path.join(os.path.dirname(path), "." + os.path.basename(path) + ".part")
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_buffer(tmp_path, data)
+        os.replace(tmp_path, path)
+        print(f"[INFO] Raw kept: {path}")
+        return True
+    except OSError as e:
+        print(f"[WARN] Cannot keep raw {path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+
+def capture_daily_direct(cam_id, epoch, burst=1, t_switch=None, cam=None):
+    """
+    Daily AR2020 frame decoded in-process from the mapped V4L2 buffer (or the
+    burst mean) and zipped like file_watcher.process_daily does. The first
+    frame is awaited with first_frame() (t_switch: see grab_frame). The buffer is
+    requeued only after the decode; with DAILY_RAW_DIR the raw is written
+    from the same buffer by a thread while the decode runs. If the decode
+    fails, that same frame is handed to file_watcher in HANDOFF_DIR instead.
+    cam is an open, formatted V4l2Capture to reuse (sweep), streaming is
+    stopped again afterwards; None opens /dev/video0 here.
+    Returns the handoff path, or None when decoded and zipped. Raises
+    FrameUnavailable when no frame was obtained, anything else is not
+    worth a second capture (it would not be the same frame).
+    """
+    import file_watcher
+    import raw_imx93
+    from v4l2_capture import V4l2Capture
+
+    if cam is None:
+        try:
+            cam = V4l2Capture(AR2020_DEVICE)
+            cam.set_format(AR2020_WIDTH, AR2020_HEIGHT, AR2020_FORMAT)
+        except Exception as e:
+            if cam is not None:
+                cam.close()
+            raise FrameUnavailable(f"{AR2020_DEVICE}: {e}") from e
+        with cam:
+            return capture_daily_direct(cam_id, epoch, burst, t_switch, cam)
+
+    camera = f"CAM{cam_id}"
+    name = f"daily_{camera}_{epoch}.raw"
+    os.makedirs(DIRECT_WORK_DIR, exist_ok=True)
+    base_output = os.path.join(DIRECT_WORK_DIR, f"{camera}_{epoch}")
+    args = raw_imx93.build_parser().parse_args(
+        [name, "--camera", camera] + file_watcher.decoder_args(base_output))
+
+    t0 = time.perf_counter()
+    handoff = None
+    try:
+        try:
+            frame = first_frame(cam, camera, time.monotonic() if t_switch is None else t_switch,
+                                BURST_BUFFERS if burst > 1 else None)
+            if burst > 1:
+                cam.requeue(frame)
+                frame = None
+                samples, info = cam.stack_frames(burst)
+                data = memoryview(samples).cast('B')
+                print(f"[INFO] Burst of {burst} frames #{info['sequences'][0]}-#{info['sequences'][-1]} "
+                      f"({info['dropped']} dropped)")
+            else:
+                data = frame.data
+                print(f"[INFO] Frame #{frame.sequence} ts={frame.timestamp:.6f}")
+        except Exception as e:
+            raise FrameUnavailable(str(e)) from e
+        writer = None
+        failure = None
+        try:
+            if DAILY_RAW_DIR:
+                writer = threading.Thread(target=_persist_raw,
+                                          args=(os.path.join(DAILY_RAW_DIR, name), data))
+                writer.start()
+            raw_imx93.convert(args, buffer=data)
+        except Exception as e:
+            # Keep only the message: the traceback holds raw_img, a numpy view
+            # of data, and would keep the V4L2 buffer exported past requeue()
+            failure = f"{type(e).__name__}: {e}"
+        if writer is not None:
+            writer.join()
+        if failure:
+            # Hand over the frame in hand, a recapture would not match a kept raw
+            print(f"[WARN] In-process decode failed ({failure}), handing the frame to file_watcher")
+            handoff = os.path.join(HANDOFF_DIR, name)
+            if not _persist_raw(handoff, data):
+                handoff = None
+        data = None
+        if frame is not None:
+            gc.collect()
+            cam.requeue(frame)
+    finally:
+        cam.stop()
+    if failure:
+        if handoff is None:
+            raise RuntimeError(f"in-process decode failed ({failure}), frame lost")
+        return handoff
+    print(f"[INFO] Decoded in-process in {time.perf_counter() - t0:.3f}s")
+
+    id_str = f"{file_watcher.get_next_id():06d}"
+    low_zip, high_zip = file_watcher.package_daily(camera, epoch, base_output, id_str)
+    print(f"[DONE] Daily {camera} → {low_zip} / {high_zip}")
+    return None
+
+def grab_v4l2_ctl(filepath):
+    """Fallback through v4l2-ctl, True when a non-empty frame file was written."""
+    cmd = (
+        f'v4l2-ctl --device={AR2020_DEVICE} '
+        f'--set-fmt-video=width={AR2020_WIDTH},height={AR2020_HEIGHT},pixelformat={AR2020_FORMAT} && '
+        f'v4l2-ctl --device={AR2020_DEVICE} '
+        f'--stream-mmap --stream-count=1 --stream-to="{filepath}" --verbose'
+    )
+    return run_cmd(cmd, timeout=5) and os.path.exists(filepath) and os.path.getsize(filepath) > 0
+
+def switch_ar2020(cam_id):
+    """
+    Chuyển PCA9544 lane + TCA6416 sensor sang camera cam_id (+ AR2020_MIN_SETTLE
+    nếu có); trả về thời điểm chuyển (time.monotonic) cho first_frame().
+    """
     print(f"[INFO] Switching to AR2020 camera {cam_id}...")
-    lane_path = "/sys/bus/i2c/devices/2-0070/lane_switch/current_lane"
-    sensor_path = "/sys/bus/i2c/devices/2-0020/sensor_switch/current_sensor"
 
     try:
-        run_cmd(f"echo {cam_id} > {lane_path}", timeout=2)
-        run_cmd(f"echo {cam_id} > {sensor_path}", timeout=2)
+        run_cmd(f"echo {cam_id} > {LANE_PATH}", timeout=2)
+        run_cmd(f"echo {cam_id} > {SENSOR_PATH}", timeout=2)
     except Exception as e:
         print(f"[WARN] Switch sensor/pca failed: {e}")
 
-    time.sleep(1.5)  # đợi ổn định 1s
+    # sysfs store cập nhật current_* ngay, không báo sensor sẵn sàng:
+    # first_frame() đợi khung đầu tiên trong DQBUF, không ngủ cố định
+    t_switch = time.monotonic()
+    if AR2020_MIN_SETTLE > 0:
+        time.sleep(AR2020_MIN_SETTLE)
+    return t_switch
+
+def capture_ar2020(cam_id, mode, burst=1):
+    """
+    Chụp ảnh từ camera AR2020 (0–3), burst > 1 = trung bình N khung liên tiếp.
+    Trả về True nếu chụp thành công.
+    """
+    # === SWITCH SENSOR/PCA bằng sysfs ===
+    t_switch = switch_ar2020(cam_id)
 
     # === CHỤP ẢNH ===
     epoch = int(time.time())
-    save_dir = "/data/.a55_src/tmp"
+    if mode == "daily" and DAILY_DIRECT and CAPTURE_BACKEND == "v4l2":
+        try:
+            handoff = capture_daily_direct(cam_id, epoch, burst, t_switch)
+            if handoff:
+                print(f"[DONE] Captured: {handoff}")
+            return True
+        except FrameUnavailable as e:
+            # chưa có khung nào: chụp lại qua file, t_switch cũ đã hết hạn
+            print(f"[WARN] Direct daily capture got no frame ({e}), capturing to a file")
+            t_switch = None
+        except Exception as e:
+            print(f"[ERROR] CAM{cam_id} direct daily failed: {e}")
+            return False
+    save_dir = HANDOFF_DIR
     os.makedirs(save_dir, exist_ok=True)
     filename = f"{mode}_CAM{cam_id}_{epoch}.raw"
     filepath = os.path.join(save_dir, filename)
 
-    cmd = (
-        f'v4l2-ctl --device=/dev/video0 '
-        f'--set-fmt-video=width=5120,height=3840,pixelformat=BA10 && '
-        f'v4l2-ctl --device=/dev/video0 '
-        f'--stream-mmap --stream-count=1 --stream-to="{filepath}" --verbose'
-    )
-    run_cmd(cmd, timeout=5)
+    ok = True
+    if CAPTURE_BACKEND == "v4l2":
+        try:
+            grab_v4l2(filepath, burst, f"CAM{cam_id}", t_switch)
+        except Exception as e:
+            print(f"[WARN] V4L2 backend failed ({e}), falling back to v4l2-ctl")
+            if burst > 1:
+                print("[WARN] Burst needs the v4l2 backend, capturing a single frame")
+            ok = grab_v4l2_ctl(filepath)
+    else:
+        if burst > 1:
+            print("[WARN] Burst needs the v4l2 backend, capturing a single frame")
+        ok = grab_v4l2_ctl(filepath)
+    if not ok:
+        if os.path.exists(filepath):
+            os.remove(filepath)  # không để file_watcher nhận file hỏng
+        print(f"[ERROR] CAM{cam_id} capture failed")
+        return False
     print(f"[DONE] Captured: {filepath}")
+    return True
+
+def capture_sweep(cam_ids, mode, burst=1):
+    """
+    Chụp lần lượt nhiều camera AR2020 (vd. 0,1,2,3): /dev/video0 được mở và
+    set format một lần, mỗi camera chỉ chuyển lane/sensor rồi stream một
+    khung, ra một file raw mỗi camera. Daily frames honour DAILY_DIRECT like
+    a single capture (decoded in-process on the open device, no raw unless
+    DAILY_RAW_DIR). Falls back to one capture_ar2020() per camera when the
+    v4l2 backend cannot be used. Returns the cameras captured.
+    """
+    t0 = time.perf_counter()
+    save_dir = HANDOFF_DIR
+    os.makedirs(save_dir, exist_ok=True)
+    captured = []
+
+    cam = None
+    if CAPTURE_BACKEND == "v4l2":
+        try:
+            from v4l2_capture import V4l2Capture
+            cam = V4l2Capture(AR2020_DEVICE)
+            cam.set_format(AR2020_WIDTH, AR2020_HEIGHT, AR2020_FORMAT)
+        except Exception as e:
+            print(f"[WARN] V4L2 backend failed ({e}), capturing one camera at a time")
+            if cam is not None:
+                cam.close()
+            cam = None
+
+    try:
+        for cam_id in cam_ids:
+            if cam is None:
+                if capture_ar2020(cam_id, mode, burst):
+                    captured.append(f"CAM{cam_id}")
+                continue
+            t1 = time.perf_counter()
+            t_switch = switch_ar2020(cam_id)
+            epoch = int(time.time())
+            if mode == "daily" and DAILY_DIRECT:
+                try:
+                    handoff = capture_daily_direct(cam_id, epoch, burst, t_switch, cam)
+                except FrameUnavailable as e:
+                    print(f"[WARN] Direct daily capture got no frame ({e}), capturing to a file")
+                    t_switch = None
+                except Exception as e:
+                    print(f"[ERROR] CAM{cam_id} direct daily failed: {e}")
+                    continue
+                else:
+                    captured.append(f"CAM{cam_id}")
+                    if handoff:
+                        print(f"[DONE] Captured: {handoff} ({time.perf_counter() - t1:.3f}s)")
+                    else:
+                        print(f"[DONE] CAM{cam_id} decoded in-process ({time.perf_counter() - t1:.3f}s)")
+                    continue
+            filename = f"{mode}_CAM{cam_id}_{epoch}.raw"
+            filepath = os.path.join(save_dir, filename)
+            try:
+                grab_frame(cam, filepath, burst, f"CAM{cam_id}", t_switch)
+            except Exception as e:
+                print(f"[ERROR] CAM{cam_id} capture failed: {e}")
+                continue
+            captured.append(f"CAM{cam_id}")
+            print(f"[DONE] Captured: {filepath} ({time.perf_counter() - t1:.3f}s)")
+    finally:
+        if cam is not None:
+            cam.close()
+
+    print(f"[DONE] Sweep {','.join(captured) or '-'} ({len(captured)}/{len(cam_ids)} cameras) "
+          f"in {time.perf_counter() - t0:.3f}s")
+    return captured
 
 def capture_usb_cam(cam_id):
     """Chụp ảnh từ camera USB (cam_id = 4)"""
     print("[INFO] Enabling USB camera power (gpio 24)...")
     run_cmd("gpioset -t0 -c gpiochip1 24=1", timeout=5)
-    time.sleep(3)  # đợi ổn định
+    # Đợi /dev/video1 xuất hiện (thay cho sleep 3s)
+    wait_ready("UCA0", "usb", video_node_ready(USB_DEVICE), USB_READY_TIMEOUT)
 
     epoch = int(time.time())
     filename = f"oneshot_UCA0_{epoch}.jpg"
@@ -58,9 +484,9 @@ def capture_usb_cam(cam_id):
     os.makedirs("/data/.a55_src/tmp", exist_ok=True)
 
     cmd = (
-        f'v4l2-ctl --device=/dev/video1 '
+        f'v4l2-ctl --device={USB_DEVICE} '
         f'--set-fmt-video=width=1280,height=720,pixelformat=MJPG && '
-        f'v4l2-ctl --device=/dev/video1 '
+        f'v4l2-ctl --device={USB_DEVICE} '
         f'--stream-mmap --stream-count=1 --stream-to="{filepath}"'
     )
     run_cmd(cmd, timeout=5)
@@ -71,13 +497,35 @@ def capture_usb_cam(cam_id):
 
 def main():
     if len(sys.argv) < 2:
-        print("Usage: python3 capture.py <camera_id> [--daily|--oneshot]")
+        print("Usage: python3 capture.py <camera_id> [--daily|--oneshot] [--burst N]\n"
+              "       python3 capture.py all <id,id,...> [--daily|--oneshot] [--burst N]")
         sys.exit(1)
 
-    cam_id = int(sys.argv[1])
+    sweep = sys.argv[1] == "all"
+    if sweep:
+        if len(sys.argv) < 3:
+            print("[ERROR] Missing camera list, e.g. all 0,1,2,3")
+            sys.exit(1)
+        cam_ids = [int(c) for c in sys.argv[2].split(",") if c.strip()]
+        if not cam_ids or any(c not in range(0, 4) for c in cam_ids):
+            print(f"[ERROR] Sweep supports AR2020 cameras 0-3 only: {sys.argv[2]}")
+            sys.exit(1)
+        opts = sys.argv[3:]
+    else:
+        cam_id = int(sys.argv[1])
+        opts = sys.argv[2:]
+    burst = 1
+    if "--burst" in opts:
+        i = opts.index("--burst")
+        burst = int(opts[i + 1])
+        del opts[i:i + 2]
     mode = "--oneshot"
-    if len(sys.argv) > 2:
-        mode = sys.argv[2]
+    if opts:
+        mode = opts[0]
+
+    if sweep:
+        captured = capture_sweep(cam_ids, "daily" if mode == "--daily" else "oneshot", burst)
+        sys.exit(0 if len(captured) == len(cam_ids) else 1)
 
     # ========= Alias mapping cho test =========
     if cam_id == 10:
@@ -91,10 +539,8 @@ def main():
     # ==========================================
 
     if cam_id in range(0, 4):
-        if mode == "--daily":
-            capture_ar2020(cam_id, "daily")
-        else:
-            capture_ar2020(cam_id, "oneshot")
+        if not capture_ar2020(cam_id, "daily" if mode == "--daily" else "oneshot", burst):
+            sys.exit(1)
     elif cam_id == 4:
         capture_usb_cam(cam_id)
     else:
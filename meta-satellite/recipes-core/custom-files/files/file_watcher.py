@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 import os
+import glob
+import fcntl
 import time
 import shutil
 import subprocess
@@ -27,15 +29,23 @@ RAW_DECODER = "/home/root/tools/raw_imx93.py"
 JPG_COMPRESS = "/home/root/tools/jpg_compress.py"
 RAW_HEIGHT = 3840
 RAW_WIDTH = 5120
+# Daily high product as JPEG tiles of this size plus an index, zipped
+# together so the ground can request single tiles (0 = one JPEG)
+HIGH_TILE = 0
+# Store Oneshot CAM raws as packed MIPI RAW10 (<name>.mipi, 5 bytes per
+# 4 pixels, 37.5% smaller than the captured raw10p); raweye.py reads .mipi
+# as MipiRawImage (".raw10" would be the LSB-first Raw10Image layout)
+ONESHOT_PACK = False
+# Per-frame stage metrics of raw_imx93 (one JSON line per frame), None = off
+METRICS_LOG = None  # e.g. os.path.join(DATA_DIR, ".a55_src/raw_metrics.jsonl")
 
 # ===============================
 # UTILS
 # ===============================
 def get_next_id():
-    if not os.path.exists(ID_FILE):
-        with open(ID_FILE, "w") as f:
-            f.write("0")
-    with open(ID_FILE, "r+") as f:
+    # capture.py (DAILY_DIRECT) cũng tăng bộ đếm: khóa cả đọc-ghi
+    with os.fdopen(os.open(ID_FILE, os.O_RDWR | os.O_CREAT, 0o644), "r+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
         current = int(f.read().strip() or "0")
         new_id = current + 1
         f.seek(0)
@@ -44,6 +54,10 @@ def get_next_id():
     return new_id
 
 
+def metrics_args():
+    return ["-M", METRICS_LOG] if METRICS_LOG else []
+
+
 def zip_files(file_list, dest_zip):
     with zipfile.ZipFile(dest_zip, "w", zipfile.ZIP_DEFLATED) as zipf:
         for f in file_list:
@@ -52,11 +66,48 @@ def zip_files(file_list, dest_zip):
 
 def process_oneshot(file_path):
     filename = os.path.basename(file_path)
+    stem, ext = os.path.splitext(filename)
+    if ONESHOT_PACK and "_CAM" in filename and ext.lower() == ".raw":
+        from raw_decoder import repack_mipi
+        dest_path = os.path.join(ONESHOT_DIR, stem + ".mipi")
+        repack_mipi(file_path, dest_path, RAW_WIDTH, RAW_HEIGHT)
+        os.remove(file_path)
+        print(f"[Oneshot] Packed {filename} to {dest_path}")
+        return
     dest_path = os.path.join(ONESHOT_DIR, filename)
     shutil.move(file_path, dest_path)
     print(f"[Oneshot] Moved {filename} to {dest_path}")
 
 
+def decoder_args(base_output):
+    """raw_imx93 options shared by the watcher and capture.py's direct daily path."""
+    args = ["-H", str(RAW_HEIGHT), "-W", str(RAW_WIDTH), "-o", base_output]
+    if HIGH_TILE:
+        args += ["-t", str(HIGH_TILE)]
+    return args + metrics_args()
+
+
+def package_daily(camera, epoch, base_output, id_str):
+    """Zip the raw_imx93 outputs of base_output into Daily Low/HighRes and remove them."""
+    tmp_output_low = base_output + "_low.jpg"
+    if HIGH_TILE:
+        # <base>_high_rXXcYY.jpg tiles + <base>_high_index.json
+        tmp_outputs_high = sorted(glob.glob(base_output + "_high_r*c*.jpg"))
+        tmp_outputs_high.append(base_output + "_high_index.json")
+    else:
+        tmp_outputs_high = [base_output + "_high.jpg"]
+
+    low_zip = os.path.join(DAILY_LOWRES_DIR, f"L{id_str}_{camera}_{epoch}.zip")
+    high_zip = os.path.join(DAILY_HIGHRES_DIR, f"H{id_str}_{camera}_{epoch}.zip")
+    zip_files([tmp_output_low], low_zip)
+    zip_files(tmp_outputs_high, high_zip)
+
+    os.remove(tmp_output_low)
+    for f in tmp_outputs_high:
+        os.remove(f)
+    return low_zip, high_zip
+
+
 def process_daily(file_path):
     filename = os.path.basename(file_path)
     parts = filename.split("_")
@@ -69,29 +120,12 @@ def process_daily(file_path):
     next_id = get_next_id()
     id_str = f"{next_id:06d}"
 
-    tmp_output_low = os.path.join(TMP_DIR, f"{camera}_{epoch}_low.jpg")
-    tmp_output_high = os.path.join(TMP_DIR, f"{camera}_{epoch}_high.jpg")
-
     if camera.startswith("CAM"):
         base_output = os.path.join(TMP_DIR, f"{camera}_{epoch}")
-        subprocess.run([
-            "python3", RAW_DECODER,
-            "-H", str(RAW_HEIGHT),
-            "-W", str(RAW_WIDTH),
-            file_path,
-            "-o", base_output
-        ], check=True)
-
-        tmp_output_low = base_output + "_low.jpg"
-        tmp_output_high = base_output + "_high.jpg"
-
-        low_zip = os.path.join(DAILY_LOWRES_DIR, f"L{id_str}_{camera}_{epoch}.zip")
-        high_zip = os.path.join(DAILY_HIGHRES_DIR, f"H{id_str}_{camera}_{epoch}.zip")
-        zip_files([tmp_output_low], low_zip)
-        zip_files([tmp_output_high], high_zip)
+        cmd = ["python3", RAW_DECODER, file_path] + decoder_args(base_output)
+        subprocess.run(cmd, check=True)
 
-        os.remove(tmp_output_low)
-        os.remove(tmp_output_high)
+        low_zip, high_zip = package_daily(camera, epoch, base_output, id_str)
         os.remove(file_path)
         print(f"[Daily CAM] {filename} → {low_zip} / {high_zip}")
     else:
@@ -131,9 +165,9 @@ def process_autotest(file_path):
             high_dest = os.path.join(AUTOTEST_IMG_HIGH_A, filename)
             print(f"[Autotest JPG] {filename} → after (A)")
 
-        subprocess.run(["python3", JPG_COMPRESS, file_path, low_dest, "--low"], check=True)
-        time.sleep(1)
-        subprocess.run(["python3", JPG_COMPRESS, file_path, high_dest, "--high"], check=True)
+        # Một lần decode cho cả low và high
+        subprocess.run(["python3", JPG_COMPRESS,
+                        "--job", file_path, f"low={low_dest}", f"high={high_dest}"], check=True)
         os.remove(file_path)
 
     # --- RAW camera cases ---
@@ -148,7 +182,7 @@ def process_autotest(file_path):
             "-c",
             file_path,
             "-o", base_output
-        ], check=True)
+        ] + metrics_args(), check=True)
 
         # Sau khi chạy, sẽ có 2 file:
         #   <basename>_low.jpg
@@ -172,7 +206,7 @@ def process_autotest(file_path):
             "-c",
             file_path,
             "-o", base_output
-        ], check=True)
+        ] + metrics_args(), check=True)
 
         low_path = base_output + "_low.jpg"
         high_path = base_output + "_high.jpg"
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Byte-budget JPEG encoding - pick the highest quality whose JPEG fits a
+downlink byte budget. Encodes go to in-memory buffers; a downscaled proxy
+gives the first guess, and the quality found for each camera/product is
+cached as the starting point for the next frame.
+"""
+import io
+import os
+import json
+import time
+import threading
+import argparse
+
+QUALITY_CACHE_PATH = "/data/.a55_src/jpeg_quality.json"
+QUALITY_MIN = 5
+QUALITY_MAX = 95
+PROXY_FACTOR = 4                # proxy = image reduced 4x in both directions
+
+# Shared by every QualityCache of the process: concurrent encodes read,
+# update and replace the same file
+_CACHE_LOCK = threading.Lock()
+
+def encode_jpeg(img, quality, **opts):
+    """JPEG bytes of a PIL image at the given quality."""
+    buf = io.BytesIO()
+    img.save(buf, format='JPEG', quality=quality, **opts)
+    return buf.getvalue()
+
+class QualityCache(object):
+    """Last quality that fitted the budget, per camera and product, in a JSON file."""
+    def __init__(self, path=QUALITY_CACHE_PATH):
+        self.path = path
+        self.lock = _CACHE_LOCK
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, camera, product):
+        with self.lock:
+            entry = self._read().get(f"{camera}/{product}")
+        return entry['quality'] if entry else None
+
+    def put(self, camera, product, budget, quality, size):
+        with self.lock:
+            data = self._read()
+            data[f"{camera}/{product}"] = {'budget': budget, 'quality': quality, 'size': size,
+                                           'time': int(time.time())}
+            # unique temp name, other processes may be replacing the file too
+            tmp = "%s.%d.%d.tmp" % (self.path, os.getpid(), threading.get_ident())
+            try:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                with open(tmp, 'w') as f:
+                    json.dump(data, f)
+                os.replace(tmp, self.path)
+            except OSError as e:
+                print(f"[WARN] Cannot write quality cache {self.path}: {e}")
+
+def search_quality(img, budget, start, qmin=QUALITY_MIN, qmax=QUALITY_MAX, **opts):
+    """
+    Highest quality in [qmin, qmax] whose JPEG fits `budget` bytes.
+    Gallops away from `start` (1, 2, 4... steps) until the answer is
+    bracketed, then bisects, so a good start costs one or two encodes.
+    Returns (quality, data, encodes); data is None when not even qmin fits.
+    """
+    lo, hi = qmin - 1, qmax + 1             # lo fits, hi does not (virtual bounds)
+    best = None
+    q = min(max(start, qmin), qmax)
+    step = 1
+    encodes = 0
+    while hi - lo > 1:
+        data = encode_jpeg(img, q, **opts)
+        encodes += 1
+        if len(data) <= budget:
+            lo, best = q, data
+            nxt = q + step
+        else:
+            hi = q
+            nxt = q - step
+        step *= 2
+        if not lo < nxt < hi:
+            nxt = (lo + hi) // 2
+        q = nxt
+    return lo, best, encodes
+
+def proxy_quality(img, budget, factor=PROXY_FACTOR, **opts):
+    """First guess of the quality from a reduced proxy and the area-scaled budget."""
+    if min(img.size) < factor * 64:
+        return (QUALITY_MIN + QUALITY_MAX) // 2
+    proxy = img.reduce(factor)
+    q, _, _ = search_quality(proxy, budget // (factor * factor), (QUALITY_MIN + QUALITY_MAX) // 2, **opts)
+    return q
+
+def fit_budget(img, budget, camera=None, product='jpeg', cache=None, **opts):
+    """
+    Encode `img` to at most `budget` bytes at the highest quality found.
+    Starts from the cached quality of camera/product, or the proxy guess.
+    Returns (quality, data, encodes); when even QUALITY_MIN is too big the
+    QUALITY_MIN encode is returned and the budget is exceeded.
+    """
+    start = cache.get(camera, product) if cache is not None and camera else None
+    if start is None:
+        start = proxy_quality(img, budget, **opts)
+    q, data, encodes = search_quality(img, budget, start, **opts)
+    if data is None:
+        q, data = QUALITY_MIN, encode_jpeg(img, QUALITY_MIN, **opts)
+        encodes += 1
+    if cache is not None and camera:
+        cache.put(camera, product, budget, q, len(data))
+    return q, data, encodes
+
+def main():
+    from PIL import Image
+
+    parser = argparse.ArgumentParser(description='Encode an image as JPEG within a byte budget.')
+    parser.add_argument('input', help='Input image')
+    parser.add_argument('output', help='Output JPEG')
+    parser.add_argument('-b', dest='budget', type=int, required=True, help='Byte budget')
+    parser.add_argument('--camera', dest='camera', default=None,
+                        help='Camera id for the quality cache (default: no cache)')
+    args = parser.parse_args()
+
+    img = Image.open(args.input).convert('RGB')
+    t0 = time.perf_counter()
+    q, data, encodes = fit_budget(img, args.budget, args.camera, 'jpeg',
+                                  QualityCache() if args.camera else None,
+                                  subsampling=2, optimize=True)
+    with open(args.output, 'wb') as f:
+        f.write(data)
+    print(f"[v] Saved: {args.output} quality={q} size={len(data)}/{args.budget} B "
+          f"({encodes} encodes, {time.perf_counter() - t0:.2f}s)")
+
+if __name__ == "__main__":
+    main()
@@ -2,63 +2,176 @@
 from PIL import Image
 import argparse
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from jpeg_budget import fit_budget, QualityCache
 
 SCALE = 1.0
 QUALITY = 10
 
-def compress_image(input_path, output_path, scale, quality, crop=False):
-    img = Image.open(input_path).convert("RGB")
+# Output presets: name -> (scale, quality, crop)
+PRESETS = {
+    "jpeg": (SCALE, QUALITY, False),
+    "high": (1.0, 10, True),    # kích hoạt crop cho high quality
+    "low": (0.2, 20, True),     # kích hoạt crop cho low quality
+}
+
+# One quality cache for every job/thread of the process
+QUALITY_CACHE = QualityCache()
+
+def camera_id(path):
+    """CAMx / UCAx id from a capture file name, None when absent."""
+    m = re.search(r'((?:CAM|UCA)\d+)', os.path.basename(path))
+    return m.group(1) if m else None
+
+def open_image(input_path, scale, log=print):
+    """
+    Decode input_path once for outputs down to `scale`, returns (img, full size).
+    JPEGs are decoded by libjpeg straight at 1/2, 1/4 or 1/8, the smallest
+    of them that is still >= the output size.
+    """
+    img = Image.open(input_path)
     w, h = img.size
+    if scale < 1.0 and img.format == "JPEG":
+        img.draft("RGB", (int(w * scale), int(h * scale)))
+        if img.size != (w, h):
+            log(f"[v] Draft decode: {w}x{h} → {img.size[0]}x{img.size[1]}")
+    return img.convert("RGB"), (w, h)
+
+def render(img, size, scale, crop, log=print):
+    """Crop/resize a decoded image; bounds are defined on the full `size` and mapped to img."""
+    w, h = size
+    fy = img.height / h
+    out_w, out_h = w, h
 
     if crop:
         top_crop = int(h * 0.25)
         bottom_crop = h - int(h * 0.20)
-        img = img.crop((0, top_crop, w, bottom_crop))
-        print(f"[v] Cropped: removed 15% top/bottom → new size: {img.size[0]}x{img.size[1]}")
+        out_h = bottom_crop - top_crop
+        img = img.crop((0, round(top_crop * fy), img.width, round(bottom_crop * fy)))
+        log(f"[v] Cropped: removed 15% top/bottom → new size: {out_w}x{out_h}")
 
     if scale < 1.0:
-        new_size = (int(img.width * scale), int(img.height * scale))
+        new_size = (int(out_w * scale), int(out_h * scale))
         img = img.resize(new_size)
-        print(f"[v] Resized: {w}x{h} → {new_size[0]}x{new_size[1]}")
+        log(f"[v] Resized: {w}x{h} → {new_size[0]}x{new_size[1]}")
+    elif img.width != out_w:
+        img = img.resize((out_w, out_h))
+    return img
 
+def save_image(img, input_path, output_path, scale, quality, crop=False, budget=None,
+               camera=None, product='jpeg', log=print):
     os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
 
-    img.save(
-        output_path,
-        format="JPEG",
-        quality=quality,
-        subsampling=2,  # 4:2:0 chroma subsampling
-        optimize=True,
-        progressive=True
-    )
+    opts = dict(subsampling=2,  # 4:2:0 chroma subsampling
+                optimize=True,
+                progressive=True)
+    if budget:
+        # Highest quality that fits the downlink budget, searched from the
+        # last quality of this camera
+        quality, data, encodes = fit_budget(img, budget, camera or camera_id(input_path), product,
+                                            QUALITY_CACHE, **opts)
+        with open(output_path, "wb") as f:
+            f.write(data)
+        log(f"[v] Budget {budget} B: quality={quality} after {encodes} encodes")
+    else:
+        img.save(output_path, format="JPEG", quality=quality, **opts)
 
     old_size = os.path.getsize(input_path) / 1024
     new_size = os.path.getsize(output_path) / 1024
-    print(f"[v] Saved: {output_path}")
-    print(f"   Quality={quality}, Scale={scale}, Crop={crop}")
-    print(f"   Size: {old_size:.1f} KB → {new_size:.1f} KB ({new_size/old_size*100:.1f}%)")
+    log(f"[v] Saved: {output_path}")
+    log(f"   Quality={quality}, Scale={scale}, Crop={crop}")
+    log(f"   Size: {old_size:.1f} KB → {new_size:.1f} KB ({new_size/old_size*100:.1f}%)")
+
+def compress_image(input_path, output_path, scale, quality, crop=False, budget=None,
+                   camera=None, product='jpeg'):
+    img, size = open_image(input_path, scale)
+    img = render(img, size, scale, crop)
+    save_image(img, input_path, output_path, scale, quality, crop, budget, camera, product)
+
+def compress_presets(input_path, outputs, camera=None, log=print):
+    """
+    Write several presets of one input: outputs is [(preset, output_path, budget)],
+    budget being the byte budget of that output or None for the preset quality.
+    The input is decoded once, at the draft scale of the largest preset.
+    """
+    img, size = open_image(input_path, max(PRESETS[p][0] for p, _, _ in outputs), log)
+    for preset, output_path, budget in outputs:
+        scale, quality, crop = PRESETS[preset]
+        out = render(img, size, scale, crop, log)
+        save_image(out, input_path, output_path, scale, quality, crop, budget, camera, preset, log)
+
+def compress_batch(jobs, workers=None, camera=None):
+    """
+    Run compress_presets() for jobs [(input_path, [(preset, output_path, budget)])]
+    on a thread pool (PIL releases the GIL while decoding, resizing and
+    encoding). Log lines are printed per job. Returns the failed inputs.
+    """
+    def run(job):
+        lines = []
+        try:
+            compress_presets(job[0], job[1], camera, lines.append)
+            return lines, None
+        except Exception as e:
+            lines.append(f"[ERROR] {job[0]}: {e}")
+            return lines, job[0]
+
+    workers = max(1, min(workers or os.cpu_count() or 1, len(jobs)))
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for lines, bad in pool.map(run, jobs):
+            print("\n".join(lines))
+            if bad:
+                failed.append(bad)
+    return failed
+
+def job_arg(text, budget=None):
+    """PRESET=OUTPUT[:BYTES] job option value -> (preset, output, budget)."""
+    preset, _, output = text.partition("=")
+    path, sep, size = output.rpartition(":")
+    if sep and size.isdigit():
+        output, budget = path, int(size)
+    if preset not in PRESETS or not output:
+        raise argparse.ArgumentTypeError(f"expected PRESET=OUTPUT[:BYTES] with PRESET in {sorted(PRESETS)}")
+    return preset, output, budget
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Compress JPG with adjustable presets.")
-    parser.add_argument("input", help="Input JPG file path")
-    parser.add_argument("output", help="Output JPG file path")
+    parser.add_argument("input", nargs="?", help="Input JPG file path")
+    parser.add_argument("output", nargs="?", help="Output JPG file path")
     group = parser.add_mutually_exclusive_group()
     group.add_argument("--high", action="store_true", help="High quality: scale=1.0, quality=10")
     group.add_argument("--low", action="store_true", help="Low quality: scale=0.2, quality=20 + crop")
+    parser.add_argument("--job", nargs="+", action="append", default=[], metavar="INPUT PRESET=OUTPUT[:BYTES]",
+                        help="Batch job: decode INPUT once and write every PRESET=OUTPUT, "
+                             "BYTES = byte budget of that output (repeatable)")
+    parser.add_argument("-j", dest="workers", type=int, default=None,
+                        help="Batch worker threads (default: CPU count)")
+    parser.add_argument("--budget", type=int, default=None,
+                        help="Byte budget: search the quality instead of using the preset one "
+                             "(with --job only for single-preset jobs, else use :BYTES)")
+    parser.add_argument("--camera", default=None,
+                        help="Camera id for the quality cache (default: CAMx/UCAx from the file name)")
     args = parser.parse_args()
 
-    scale = SCALE
-    quality = QUALITY
-    crop = False
+    if args.job:
+        if args.input or args.high or args.low:
+            parser.error("--job cannot be combined with INPUT OUTPUT / --high / --low")
+        if args.budget and any(len(job) > 2 for job in args.job):
+            parser.error("--budget would give every preset of a job the same budget, "
+                         "use PRESET=OUTPUT:BYTES per output instead")
+        try:
+            jobs = [(job[0], [job_arg(spec, args.budget) for spec in job[1:]]) for job in args.job]
+        except argparse.ArgumentTypeError as e:
+            parser.error(str(e))
+        if not all(outputs for _, outputs in jobs):
+            parser.error("every --job needs at least one PRESET=OUTPUT")
+        raise SystemExit(1 if compress_batch(jobs, args.workers, args.camera) else 0)
 
-    if args.high:
-        scale = 1.0
-        quality = 10
-        crop = True  # kích hoạt crop cho high quality
-    elif args.low:
-        scale = 0.2
-        quality = 20
-        crop = True  # kích hoạt crop cho low quality
+    if not args.input or not args.output:
+        parser.error("INPUT and OUTPUT are required without --job")
 
-    compress_image(args.input, args.output, scale, quality, crop)
+    product = "high" if args.high else "low" if args.low else "jpeg"
+    scale, quality, crop = PRESETS[product]
+    compress_image(args.input, args.output, scale, quality, crop, args.budget, args.camera, product)
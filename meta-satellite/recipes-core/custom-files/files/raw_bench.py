@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+Raw decoder benchmark - wall time and peak RSS of each decode path.
+Every case runs in its own child process, so ru_maxrss of one case is not
+polluted by the previous ones.
+
+--suite times every loader class on synthetic frames of each format and
+size (generated once into -d) and reports MP/s. --save writes the results
+as a JSON baseline, --baseline compares against one and exits with 1 when
+a case got slower than --threshold.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import tempfile
+import numpy as np
+from raw_decoder import *
+from raw_decoder import _pack_mipiraw
+import raw_imx93
+
+RAW_HEIGHT = 3840
+RAW_WIDTH = 5120
+
+SUITE_DIR = '/tmp/raw_bench'
+SUITE_SIZES = ((RAW_WIDTH, RAW_HEIGHT), (1280, 960))
+SUITE_THRESHOLD = 0.15          # flag a case more than 15% slower than the baseline
+
+def synthetic_codes(width, height, bits=10, seed=0, rows=256):
+    """Yield uint16 (rows, width) strips of a smooth gradient + noise frame of `bits`-bit codes."""
+    rng = np.random.default_rng(seed)
+    k = (2**bits - 1) / 1023.0
+    for r0 in range(0, height, rows):
+        r1 = min(r0 + rows, height)
+        y = np.arange(r0, r1, dtype=np.float32)[:, None] / height
+        x = np.arange(width, dtype=np.float32)[None, :] / width
+        v = 200 + 600 * x * (1 - y) + rng.normal(0, 8, (r1 - r0, width))
+        v *= k
+        np.clip(v, 0, 2**bits - 1, out=v)
+        yield v.astype(np.uint16)
+
+def _pack_raw10(codes):
+    """Inverse of the raw10 unpacker (Raw10Image layout, LSB first)."""
+    x1, x2, x3, x4 = [codes[:, k::4] for k in range(4)]
+    out = np.empty((codes.shape[0], codes.shape[1] // 4, 5), dtype=np.uint8)
+    out[..., 0] = x1 & 0xFF
+    out[..., 1] = (x1 >> 8) | ((x2 & 0x3F) << 2)
+    out[..., 2] = (x2 >> 6) | ((x3 & 0x0F) << 4)
+    out[..., 3] = (x3 >> 4) | ((x4 & 0x03) << 6)
+    out[..., 4] = x4 >> 2
+    return out
+
+def _pack_mipi(codes):
+    out = np.empty((codes.shape[0], codes.shape[1] * 5 // 4), dtype=np.uint8)
+    _pack_mipiraw(codes, out)
+    return out
+
+def make_raw10p(path, width, height, seed=0):
+    """Write a synthetic raw10p frame (smooth gradient + noise, 10 bits in 16)."""
+    with open(path, 'wb') as f:
+        for codes in synthetic_codes(width, height, 10, seed):
+            codes.astype('<u2').tofile(f)
+
+def _write_bayer(bits, pack):
+    def write(path, width, height, seed=0):
+        with open(path, 'wb') as f:
+            for codes in synthetic_codes(width, height, bits, seed):
+                pack(codes).tofile(f)
+    return write
+
+def _write_nv12(path, width, height, seed=0):
+    """Luma gradient + noise, then interleaved chroma at (h/2, w)."""
+    with open(path, 'wb') as f:
+        for codes in synthetic_codes(width, height, 8, seed):
+            codes.astype(np.uint8).tofile(f)
+        for codes in synthetic_codes(width, height // 2, 8, seed + 1):
+            codes.astype(np.uint8).tofile(f)
+
+def _write_rawz(path, width, height, seed=0):
+    src = path + '.raw10p'
+    make_raw10p(src, width, height, seed)
+    try:
+        write_rawz(Raw10PaddedImage(src, width, height), path)
+    finally:
+        os.remove(src)
+
+
+# format: (loader class, writer, Bayer loader)
+FORMATS = {
+    'raw10': (Raw10Image, _write_bayer(10, _pack_raw10), True),
+    'mipi': (MipiRawImage, _write_bayer(10, _pack_mipi), True),
+    'raw10p': (Raw10PaddedImage, make_raw10p, True),
+    'raw8': (Raw8Image, _write_bayer(8, lambda codes: codes.astype(np.uint8)), True),
+    'raw16': (Raw16Image, _write_bayer(16, lambda codes: codes.astype('<u2')), True),
+    'rawz': (RawzImage, _write_rawz, True),
+    'nv12': (YuvImage, _write_nv12, False),
+    'nv21': (YvuImage, _write_nv12, False),
+}
+
+def _unpack_case(policy):
+    def run(img):
+        RawImageBase.load(img)
+        t0 = time.perf_counter()
+        if policy == 'float64':
+            img.rawtorawf(img.raw, img.height)
+        else:
+            img.unpackMosaic(np.dtype(policy))
+        return time.perf_counter() - t0
+    return run
+
+def _load_case(policy):
+    def run(img):
+        t0 = time.perf_counter()
+        img.load(policy)
+        return time.perf_counter() - t0
+    return run
+
+def _strips_case(strip_rows, workers=1):
+    def run(img):
+        t0 = time.perf_counter()
+        img.loadStrips(strip_rows=strip_rows, workers=workers)
+        return time.perf_counter() - t0
+    return run
+
+def _demosaic_case(engine):
+    def run(img):
+        RawImageBase.load(img)
+        mosaic = img.unpackMosaic(np.uint16)
+        img.raw = None
+        t0 = time.perf_counter()
+        demosaic(mosaic, img.bayer, engine, unpack_scale(img.unpack))
+        return time.perf_counter() - t0
+    return run
+
+def _roi_case(fraction):
+    def run(img):
+        t0 = time.perf_counter()
+        img.loadRoi(0, int(img.height * fraction), 0, int(img.width * fraction))
+        return time.perf_counter() - t0
+    return run
+
+def _quicklook_case(img):
+    t0 = time.perf_counter()
+    img.quicklook()
+    return time.perf_counter() - t0
+
+def _daily_case(encode_workers):
+    """End-to-end raw_imx93 daily pair (decode + high/low encode), in process."""
+    def run(img):
+        with tempfile.TemporaryDirectory() as tmp:
+            args = raw_imx93.build_parser().parse_args([
+                '-H', str(img.height), '-W', str(img.width), '-e', str(encode_workers),
+                '-o', os.path.join(tmp, 'bench'), img.path])
+            t0 = time.perf_counter()
+            raw_imx93.convert(args, log=lambda line: None)
+            return time.perf_counter() - t0
+    return run
+
+def _idle_case(img):
+    return 0.0
+
+def _yuv_case(img):
+    t0 = time.perf_counter()
+    img.load()
+    return time.perf_counter() - t0
+
+CASES = {
+    'idle': _idle_case,
+    'unpack-float64': _unpack_case('float64'),
+    'unpack-float32': _unpack_case('float32'),
+    'unpack-uint16': _unpack_case('uint16'),
+    'load-float64': _load_case('float64'),
+    'load-float32': _load_case('float32'),
+    'load-uint16': _load_case('uint16'),
+    'strips-64': _strips_case(64),
+    'strips-256': _strips_case(256),
+    'parallel-2': _strips_case(256, 2),
+    'parallel-4': _strips_case(256, 4),
+    'roi-1/2': _roi_case(0.5),
+    'roi-1/8': _roi_case(0.125),
+    'quicklook': _quicklook_case,
+    'daily-serial': _daily_case(1),
+    'daily-parallel': _daily_case(3),
+    'load-yuv': _yuv_case,
+}
+for _name in DEMOSAIC_ENGINES:
+    CASES['demosaic-' + _name] = _demosaic_case(_name)
+
+# Loader x pipeline variants of --suite
+SUITE_BAYER_CASES = ('load-float64', 'load-float32', 'load-uint16', 'strips-256', 'parallel-4',
+                     'roi-1/8', 'quicklook')
+SUITE_YUV_CASES = ('load-yuv',)
+
+def run_case(name, path, width, height, fmt='raw10p'):
+    img = FORMATS[fmt][0](path, width, height)
+    wall = CASES[name](img)
+    print(json.dumps({'case': name, 'wall_s': wall}))
+
+def measure(name, path, width, height, fmt='raw10p'):
+    cmd = [sys.executable, os.path.abspath(__file__), '--case', name, '--format', fmt,
+           '-W', str(width), '-H', str(height), path]
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    out = p.stdout.read()
+    _, status, ru = os.wait4(p.pid, 0)
+    if status != 0:
+        return {'case': name, 'error': 'exit status %d' % status}
+    res = json.loads(out.decode().strip().splitlines()[-1])
+    res['peak_rss_mb'] = ru.ru_maxrss / 1024.0
+    res['mp_s'] = width * height / 1e6 / res['wall_s'] if res['wall_s'] > 0 else None
+    return res
+
+def size_arg(text):
+    """WxH[,WxH...] option value -> ((w, h), ...)."""
+    try:
+        sizes = tuple(tuple(int(v) for v in item.split('x')) for item in text.split(','))
+    except ValueError:
+        sizes = ((),)
+    if any(len(wh) != 2 or wh[0] % 4 or wh[1] % 2 for wh in sizes):
+        raise argparse.ArgumentTypeError("expected WxH[,WxH...] with W a multiple of 4 and H even")
+    return sizes
+
+def run_suite(args):
+    """Measure every format x size x applicable case, returns {key: result}."""
+    os.makedirs(args.dir, exist_ok=True)
+    cases = args.cases.split(',') if args.cases else None
+    results = {}
+    print(f"{'case':<40}{'wall [s]':>10}{'MP/s':>10}{'peak RSS [MB]':>16}")
+    for fmt in args.formats.split(','):
+        cls, write, bayer = FORMATS[fmt]
+        for w, h in args.sizes:
+            path = os.path.join(args.dir, f"{fmt}_{w}x{h}.{fmt}")
+            if not os.path.exists(path):
+                write(path, w, h)
+            for name in (SUITE_BAYER_CASES if bayer else SUITE_YUV_CASES):
+                if cases and name not in cases:
+                    continue
+                key = f"{fmt}/{w}x{h}/{name}"
+                res = measure(name, path, w, h, fmt)
+                results[key] = res
+                if 'error' in res:
+                    print(f"{key:<40}{res['error']:>36}")
+                    continue
+                print(f"{key:<40}{res['wall_s']:>10.3f}{res['mp_s']:>10.1f}{res['peak_rss_mb']:>16.1f}")
+    return results
+
+def compare(results, baseline, threshold):
+    """Cases slower than baseline by more than `threshold`, as (key, old, new) wall times."""
+    slower = []
+    for key, res in results.items():
+        old = baseline.get(key)
+        if not old or 'error' in old or 'error' in res:
+            continue
+        if res['wall_s'] > old['wall_s'] * (1 + threshold):
+            slower.append((key, old['wall_s'], res['wall_s']))
+    return slower
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark raw decoder paths (wall time, peak RSS).')
+    parser.add_argument('-H', dest='height', type=int, default=RAW_HEIGHT)
+    parser.add_argument('-W', dest='width', type=int, default=RAW_WIDTH)
+    parser.add_argument('--case', choices=sorted(CASES), help=argparse.SUPPRESS)
+    parser.add_argument('--format', choices=sorted(FORMATS), default='raw10p', help=argparse.SUPPRESS)
+    parser.add_argument('-c', dest='cases', default=None,
+                        help='comma separated cases to run (default: all, with --suite the loader cases)')
+    parser.add_argument('--suite', action='store_true',
+                        help='time every loader class on synthetic frames of each format and size')
+    parser.add_argument('-f', dest='formats', default=','.join(FORMATS),
+                        help='comma separated formats of --suite')
+    parser.add_argument('-s', dest='sizes', type=size_arg, default=SUITE_SIZES,
+                        help='frame sizes of --suite, WxH[,WxH...] (default: 5120x3840,1280x960)')
+    parser.add_argument('-d', dest='dir', default=SUITE_DIR,
+                        help='directory of the --suite synthetic frames')
+    parser.add_argument('--save', metavar='FILE', help='write the --suite results as a JSON baseline')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='compare the --suite results with this baseline, exit 1 on a regression')
+    parser.add_argument('--threshold', type=float, default=SUITE_THRESHOLD,
+                        help='relative slow-down flagged as a regression (default: 0.15)')
+    parser.add_argument('infile', nargs='?', default='/tmp/raw_bench.raw',
+                        help='raw10p input (generated if missing)')
+    args = parser.parse_args()
+
+    if args.case:
+        run_case(args.case, args.infile, args.width, args.height, args.format)
+        return 0
+
+    if args.suite:
+        results = run_suite(args)
+        if args.save:
+            with open(args.save, 'w') as f:
+                json.dump({'time': int(time.time()), 'results': results}, f, indent=1)
+            print(f"[v] Baseline saved: {args.save}")
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)['results']
+            slower = compare(results, baseline, args.threshold)
+            for key, old, new in slower:
+                print(f"[REGRESSION] {key}: {old:.3f}s -> {new:.3f}s (+{(new / old - 1) * 100:.0f}%)")
+            if slower:
+                return 1
+            print(f"[v] No case slower than the baseline by more than {args.threshold * 100:.0f}%")
+        return 0
+
+    if not os.path.exists(args.infile):
+        print(f"[i] Generating synthetic {args.width}x{args.height} raw10p: {args.infile}")
+        make_raw10p(args.infile, args.width, args.height)
+
+    print(f"{'case':<18}{'wall [s]':>10}{'MP/s':>10}{'peak RSS [MB]':>16}")
+    cases = args.cases.split(',') if args.cases else [n for n in CASES if n != 'load-yuv']
+    for name in cases:
+        res = measure(name, args.infile, args.width, args.height)
+        if 'error' in res:
+            print(f"{name:<18}{res['error']:>36}")
+            continue
+        mp_s = f"{res['mp_s']:>10.1f}" if res['mp_s'] else f"{'-':>10}"
+        print(f"{name:<18}{res['wall_s']:>10.3f}{mp_s}{res['peak_rss_mb']:>16.1f}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,82 +1,384 @@
-
+import os
+import json
+import time
+import struct
+import zlib
+import lzma
+import resource
+import threading
+import contextlib
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# ---------------------------------------------------------------------------
+# Stage profiling
+#
+# Opt-in: decode paths wrap their stages in profile_stage(profiler, name),
+# which is a shared no-op context while the profiler is None.
+# ---------------------------------------------------------------------------
+_NO_STAGE = contextlib.nullcontext()
+
+def _status_kb(field):
+    """A KiB field of /proc/self/status (VmRSS, VmHWM...), None when unavailable."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def reset_peak_rss():
+    """Reset the peak RSS (VmHWM) to the current RSS, returns False where unsupported."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def rss_kb():
+    """Current resident set size, in KiB (falls back to the peak)."""
+    rss = _status_kb('VmRSS')
+    return rss if rss is not None else peak_rss_kb()
+
+def peak_rss_kb():
+    """
+    Peak resident set size since the last reset_peak_rss() in KiB, the
+    process lifetime peak (ru_maxrss) without /proc.
+    """
+    hwm = _status_kb('VmHWM')
+    return hwm if hwm is not None else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class StageProfiler(object):
+    """
+    Per-stage wall time, CPU time of the calling thread and growth of the
+    frame peak RSS, summed over calls. The peak is reset when the profiler
+    is created, so frames converted by a long-lived process (raw_service)
+    are measured from their own start rather than against the largest
+    frame so far; one profiled frame at a time per process.
+    Thread safe: stages running on worker threads add up, so wall time of
+    parallel stages can exceed the frame wall time.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.wall0 = time.perf_counter()
+        self.cpu0 = time.process_time()
+        reset_peak_rss()
+        self.rss0 = rss_kb()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        w0, c0, r0 = time.perf_counter(), time.thread_time(), peak_rss_kb()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - w0
+            cpu = time.thread_time() - c0
+            rss = peak_rss_kb() - r0
+            with self.lock:
+                st = self.stages.setdefault(name, {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0,
+                                                   'peak_rss_delta_kb': 0})
+                st['calls'] += 1
+                st['wall_s'] += wall
+                st['cpu_s'] += cpu
+                st['peak_rss_delta_kb'] += rss
+
+    def record(self, **extra):
+        """One JSON-serialisable record of the frame: totals, stages and `extra` fields."""
+        rec = dict(extra)
+        rec.update({'wall_s': time.perf_counter() - self.wall0,
+                    'cpu_s': time.process_time() - self.cpu0,
+                    'peak_rss_kb': peak_rss_kb(),
+                    'peak_rss_delta_kb': peak_rss_kb() - self.rss0})
+        with self.lock:
+            rec['stages'] = {k: dict(v) for k, v in self.stages.items()}
+        return rec
+
+def profile_stage(profiler, name):
+    return _NO_STAGE if profiler is None else profiler.stage(name)
+
+# ---------------------------------------------------------------------------
+# Demosaic engines
+#
+# Engines work on 2x2 strided sub-planes of the mosaic: for every quad site
+# (dy, dx) the neighbours are plain slices of a 2-pixel reflect-padded copy,
+# so no colour masks are built and no zero-filled planes are convolved.
+# Reflect padding keeps the Bayer phase, borders interpolate from same
+# colour pixels. Engines take (raw, pattern, scale) and return float32 RGB,
+# `scale` normalises integer codes to [0, 1].
+# ---------------------------------------------------------------------------
+
+# pattern: ((row, col) of R, (row, col) of B) inside the 2x2 quad
+BAYER_OFFSETS = {
+    'rggb': ((0, 0), (1, 1)),
+    'bggr': ((1, 1), (0, 0)),
+    'grbg': ((0, 1), (1, 0)),
+    'gbrg': ((1, 0), (0, 1)),
+}
+
+# name: (engine, output downscale)
+DEMOSAIC_ENGINES = {}
+
+def register_demosaic(name, downscale=1):
+    def deco(fn):
+        DEMOSAIC_ENGINES[name] = (fn, downscale)
+        return fn
+    return deco
+
+def demosaic(raw, pattern='rggb', engine='bilinear', scale=1.0, clip=True):
+    """
+    Demosaic `raw` (h, w) with the registered `engine`.
+    Returns float32 (h/d, w/d, 3), d being the engine downscale.
+    """
+    if pattern not in BAYER_OFFSETS:
+        raise ValueError("Unsupported Bayer pattern")
+    if engine not in DEMOSAIC_ENGINES:
+        raise ValueError("Unsupported demosaic engine: %s" % engine)
+    rgb = DEMOSAIC_ENGINES[engine][0](raw, pattern, scale)
+    if clip:
+        np.clip(rgb, 0, 1, out=rgb)
+    return rgb
 
 def demosaic_bilinear(raw, pattern='rggb'):
     """
     Simple bilinear demosaic using pure numpy (no scipy).
     pattern: one of ['rggb', 'bggr', 'grbg', 'gbrg']
     """
+    return demosaic(raw, pattern, 'bilinear')
+
+def _bayer_sites(pattern):
+    """{(dy, dx): channel} for the four quad sites, R=0 G=1 B=2."""
+    (ry, rx), (by, bx) = BAYER_OFFSETS[pattern]
+    sites = {(dy, dx): 1 for dy in (0, 1) for dx in (0, 1)}
+    sites[(ry, rx)] = 0
+    sites[(by, bx)] = 2
+    return sites
+
+def _pad_reflect2(raw, scale=1.0):
     h, w = raw.shape
-    rgb = np.zeros((h, w, 3), dtype=np.float32)
-
-    # mask positions for each color in Bayer
-    if pattern == 'rggb':
-        r_mask = np.tile([[1,0],[0,0]], (h//2, w//2))
-        g_mask = np.tile([[0,1],[1,0]], (h//2, w//2))
-        b_mask = np.tile([[0,0],[0,1]], (h//2, w//2))
-    elif pattern == 'bggr':
-        b_mask = np.tile([[1,0],[0,0]], (h//2, w//2))
-        g_mask = np.tile([[0,1],[1,0]], (h//2, w//2))
-        r_mask = np.tile([[0,0],[0,1]], (h//2, w//2))
-    elif pattern == 'grbg':
-        g_mask = np.tile([[1,0],[0,1]], (h//2, w//2))
-        r_mask = np.tile([[0,1],[0,0]], (h//2, w//2))
-        b_mask = np.tile([[0,0],[1,0]], (h//2, w//2))
-    elif pattern == 'gbrg':
-        g_mask = np.tile([[0,1],[1,0]], (h//2, w//2))
-        b_mask = np.tile([[1,0],[0,0]], (h//2, w//2))
-        r_mask = np.tile([[0,0],[0,1]], (h//2, w//2))
-    else:
-        raise ValueError("Unsupported Bayer pattern")
+    p = np.empty((h + 4, w + 4), dtype=np.float32)
+    core = p[2:h + 2, 2:w + 2]
+    np.copyto(core, raw, casting='same_kind')
+    if scale != 1.0:
+        core *= np.float32(scale)
+    p[1], p[0] = p[3], p[4]
+    p[h + 2], p[h + 3] = p[h], p[h - 1]
+    p[:, 1], p[:, 0] = p[:, 3], p[:, 4]
+    p[:, w + 2], p[:, w + 3] = p[:, w], p[:, w - 1]
+    return p
 
-    # extract each channel
-    R = raw * r_mask
-    G = raw * g_mask
-    B = raw * b_mask
+def _site_view(p, h, w, dy, dx):
+    """Returns S(oy, ox): the (oy, ox) neighbour of every (dy, dx) quad site."""
+    def S(oy, ox):
+        y0 = 2 + dy + oy
+        x0 = 2 + dx + ox
+        return p[y0:y0 + h - 1:2, x0:x0 + w - 1:2]
+    return S
 
-    # Manual 2D convolution using numpy (bilinear kernel)
-    def convolve2d_bilinear(img):
-        # Pad image with edge values
-        padded = np.pad(img, 1, mode='edge')
-        
-        # Apply 3x3 bilinear kernel manually
-        result = (
-            1 * padded[0:-2, 0:-2] + 2 * padded[0:-2, 1:-1] + 1 * padded[0:-2, 2:] +
-            2 * padded[1:-1, 0:-2] + 4 * padded[1:-1, 1:-1] + 2 * padded[1:-1, 2:] +
-            1 * padded[2:, 0:-2]   + 2 * padded[2:, 1:-1]   + 1 * padded[2:, 2:]
-        ) / 16.0
-        
-        return result
+def _mean(out, *views):
+    np.add(views[0], views[1], out=out)
+    for v in views[2:]:
+        out += v
+    out *= np.float32(1.0 / len(views))
+    return out
+
+@register_demosaic('bilinear')
+def _demosaic_bilinear(raw, pattern, scale=1.0):
+    """Bilinear, each missing sample is the mean of its same colour neighbours."""
+    h, w = raw.shape
+    p = _pad_reflect2(raw, scale)
+    rgb = np.empty((h, w, 3), dtype=np.float32)
+    sites = _bayer_sites(pattern)
+    for (dy, dx), c in sites.items():
+        S = _site_view(p, h, w, dy, dx)
+        out = rgb[dy::2, dx::2]
+        np.copyto(out[..., c], S(0, 0))
+        if c == 1:
+            _mean(out[..., sites[(dy, dx ^ 1)]], S(0, -1), S(0, 1))
+            _mean(out[..., sites[(dy ^ 1, dx)]], S(-1, 0), S(1, 0))
+        else:
+            _mean(out[..., 1], S(-1, 0), S(1, 0), S(0, -1), S(0, 1))
+            _mean(out[..., 2 - c], S(-1, -1), S(-1, 1), S(1, -1), S(1, 1))
+    return rgb
 
-    # interpolate missing pixels
-    R = convolve2d_bilinear(R)
-    G = convolve2d_bilinear(G)
-    B = convolve2d_bilinear(B)
+@register_demosaic('half', downscale=2)
+def _demosaic_half(raw, pattern, scale=1.0):
+    """2x2 quad binning to half resolution: R, mean(Gr, Gb), B per quad."""
+    h, w = raw.shape
+    (ry, rx), (by, bx) = BAYER_OFFSETS[pattern]
+    rgb = np.empty((h // 2, w // 2, 3), dtype=np.float32)
+    np.multiply(raw[ry::2, rx::2], scale, out=rgb[..., 0], dtype=np.float32)
+    np.add(raw[ry::2, bx::2], raw[by::2, rx::2], out=rgb[..., 1], dtype=np.float32)
+    rgb[..., 1] *= np.float32(0.5 * scale)
+    np.multiply(raw[by::2, bx::2], scale, out=rgb[..., 2], dtype=np.float32)
+    return rgb
 
-    rgb[...,0] = R
-    rgb[...,1] = G
-    rgb[...,2] = B
-    np.clip(rgb, 0, 1, out=rgb)
+@register_demosaic('malvar')
+def _demosaic_malvar(raw, pattern, scale=1.0):
+    """
+    Gradient-corrected bilinear (Malvar-He-Cutler 5x5): the bilinear
+    estimate is corrected with the Laplacian of the channel that is
+    actually sampled at the site, which suppresses colour fringing on edges.
+    """
+    h, w = raw.shape
+    p = _pad_reflect2(raw, scale)
+    rgb = np.empty((h, w, 3), dtype=np.float32)
+    sites = _bayer_sites(pattern)
+    q = (h // 2, w // 2)
+    diag, far_h, far_v, t = [np.empty(q, dtype=np.float32) for _ in range(4)]
+    for (dy, dx), c in sites.items():
+        S = _site_view(p, h, w, dy, dx)
+        out = rgb[dy::2, dx::2]
+        c0 = S(0, 0)
+        np.copyto(out[..., c], c0)
+        np.add(S(-1, -1), S(-1, 1), out=diag)
+        diag += S(1, -1)
+        diag += S(1, 1)
+        np.add(S(0, -2), S(0, 2), out=far_h)
+        np.add(S(-2, 0), S(2, 0), out=far_v)
+        if c == 1:
+            # (5 G0 + 4 (W + E) - diag - (WW + EE) + (NN + SS) / 2) / 8
+            for ch, near, along, across in ((sites[(dy, dx ^ 1)], (S(0, -1), S(0, 1)), far_h, far_v),
+                                            (sites[(dy ^ 1, dx)], (S(-1, 0), S(1, 0)), far_v, far_h)):
+                o = out[..., ch]
+                np.add(near[0], near[1], out=o)
+                o *= 4
+                np.multiply(c0, 5, out=t)
+                o += t
+                o -= diag
+                o -= along
+                np.multiply(across, 0.5, out=t)
+                o += t
+                o *= np.float32(1 / 8.0)
+        else:
+            # G: (4 C0 + 2 (N + S + W + E) - (NN + SS + WW + EE)) / 8
+            o = out[..., 1]
+            np.add(S(-1, 0), S(1, 0), out=o)
+            o += S(0, -1)
+            o += S(0, 1)
+            o *= 2
+            np.multiply(c0, 4, out=t)
+            o += t
+            o -= far_h
+            o -= far_v
+            o *= np.float32(1 / 8.0)
+            # other of R/B: (6 C0 + 2 diag - 1.5 (NN + SS + WW + EE)) / 8
+            o = out[..., 2 - c]
+            np.multiply(diag, 2, out=o)
+            np.multiply(c0, 6, out=t)
+            o += t
+            np.add(far_h, far_v, out=t)
+            t *= 1.5
+            o -= t
+            o *= np.float32(1 / 8.0)
     return rgb
 
+# ---------------------------------------------------------------------------
+# White balance
+# ---------------------------------------------------------------------------
+AWB_METHODS = ('fixed', 'grayworld', 'whitepatch')
+AWB_STEP = 8                    # estimate from every 8th quad in both directions
+AWB_GAIN_LIMITS = (0.25, 8.0)
+AWB_CACHE_PATH = "/data/.a55_src/awb_gains.json"
+AWB_CACHE_MAX_AGE = 6 * 3600    # seconds a cached estimate is reused
+
+def awb_apply(mosaic, rgain, bgain, bayer='rggb'):
+    """
+    Scale the R and B sites of `mosaic` in place through strided views.
+    Integer mosaics saturate at the dtype maximum (16-bit codes times a gain
+    would otherwise wrap), scaled through float64 row chunks so 10-bit
+    results match the plain in-place multiply.
+    """
+    (ry, rx), (by, bx) = BAYER_OFFSETS[bayer]
+    top = np.iinfo(mosaic.dtype).max if mosaic.dtype.kind in 'ui' else None
+    for (y, x), gain in (((ry, rx), rgain), ((by, bx), bgain)):
+        if gain == 1.0:
+            continue
+        v = mosaic[y::2, x::2]
+        if top is None:
+            np.multiply(v, gain, out=v, casting='unsafe')
+            continue
+        for r in range(0, v.shape[0], UNPACK_CHUNK_ROWS):
+            chunk = v[r:r + UNPACK_CHUNK_ROWS]
+            t = np.multiply(chunk, gain, dtype=np.float64)
+            np.minimum(t, top, out=t)
+            np.copyto(chunk, t, casting='unsafe')
+    return mosaic
+
 def rawfAwb(rawf, rgain, bgain, bayer='rggb'):
-    hrb_map = {'rggb': np.array([[rgain, 1.0],[1.0, bgain]]),
-               'bggr': np.array([[bgain, 1.0],[1.0, rgain]]),
-               'grbg': np.array([[1.0, rgain],[bgain, 1.0]]),
-               'gbrg': np.array([[1.0, bgain],[rgain, 1.0]])}
+    return awb_apply(rawf, rgain, bgain, bayer)
 
-    h_rb = hrb_map[bayer]
-    b_width = rawf.shape[1]
-    rawf = np.hsplit(rawf, b_width/2)
-    rawf = np.vstack(rawf)
-    b_shape = rawf.shape
-    rawf = rawf.reshape(-1,2,2)
+def awb_estimate(mosaic, bayer='rggb', method='grayworld', step=AWB_STEP, white=None, percentile=99.0):
+    """
+    Estimate (rgain, bgain) from the Bayer quads taken every `step` quads.
+    Quads with a sample at or above `white` are ignored.
+      grayworld  : equalise the channel means
+      whitepatch : equalise the channel `percentile`
+    """
+    (ry, rx), (by, bx) = BAYER_OFFSETS[bayer]
+    q = 2 * step
+    r = mosaic[ry::q, rx::q].astype(np.float32)
+    b = mosaic[by::q, bx::q].astype(np.float32)
+    g1 = mosaic[ry::q, bx::q]
+    g2 = mosaic[by::q, rx::q]
+    if white is not None:
+        ok = (r < white) & (b < white) & (g1 < white) & (g2 < white)
+        r, b, g1, g2 = r[ok], b[ok], g1[ok], g2[ok]
+    if r.size == 0:
+        return 1.0, 1.0
+    g = g1.astype(np.float32)
+    g += g2
+    g *= 0.5
+
+    if method == 'grayworld':
+        stat = np.mean
+    elif method == 'whitepatch':
+        stat = lambda x: np.percentile(x, percentile)
+    else:
+        raise ValueError("Unsupported AWB method: %s" % method)
+    sr, sg, sb = [float(stat(x)) for x in (r, g, b)]
+    lo, hi = AWB_GAIN_LIMITS
+    rgain = min(max(sg / sr, lo), hi) if sr > 0 else 1.0
+    bgain = min(max(sg / sb, lo), hi) if sb > 0 else 1.0
+    return rgain, bgain
 
-    rawf = rawf * h_rb
+class AwbGainCache(object):
+    """Per-camera AWB gains kept in a JSON file, reused for up to max_age seconds."""
+    def __init__(self, path=AWB_CACHE_PATH, max_age=AWB_CACHE_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
 
-    rawf = rawf.reshape(b_shape)
-    rawf = np.hstack(np.vsplit(rawf, b_width/2))
-    return rawf
+    def get(self, camera, method):
+        entry = self._read().get(str(camera))
+        if not entry or entry.get('method') != method:
+            return None
+        if time.time() - entry.get('time', 0) > self.max_age:
+            return None
+        return entry['rgain'], entry['bgain']
+
+    def put(self, camera, method, rgain, bgain):
+        data = self._read()
+        data[str(camera)] = {'method': method, 'rgain': rgain, 'bgain': bgain,
+                             'time': int(time.time())}
+        # unique temp name: raw_service and capture.py may write concurrently
+        tmp = "%s.%d.%d.tmp" % (self.path, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"[WARN] Cannot write AWB cache {self.path}: {e}")
 
 def raw10torawf(raw, h):
     raw10 = raw.reshape(h, -1, 5).astype(np.uint16)
@@ -119,42 +421,497 @@ def mipirawtorawf(raw, h):
 
 
 def raw8torawf(raw, h):
-    return raw.reshape((h, -1))/np.float(2**8)
+    return raw.reshape((h, -1))/np.float64(2**8)
 
 def raw16torawf(raw, h):
-    return raw.reshape((h, -1))/np.float(2**16)
+    return raw.reshape((h, -1))/np.float64(2**16)
+
+# ---------------------------------------------------------------------------
+# Integer-domain unpack engine
+#
+# Each unpacker writes the 10/8/16-bit codes of `src` (rows, row units) into
+# `out` (rows, width) uint16 through strided views, so no dstack/reshape copy
+# and no float64 frame is ever made. The 10-bit variants use one of the
+# not-yet-written output columns as scratch instead of allocating temporaries.
+# ---------------------------------------------------------------------------
+def _unpack_raw10(src, out):
+    src = src.reshape(src.shape[0], -1, 5)
+    dst = out.reshape(out.shape[0], -1, 4)
+    a, b, c, d, e = [src[..., x] for x in range(5)]
+    x1, x2, x3, x4 = [dst[..., x] for x in range(4)]
+    # x1 = a + ((b & 0x03) << 8)
+    np.bitwise_and(b, 0x03, out=x1)
+    x1 <<= 8
+    x1 |= a
+    # x2 = (b >> 2) + ((c & 0x0f) << 6)
+    np.bitwise_and(c, 0x0f, out=x2)
+    x2 <<= 8
+    x2 |= b
+    x2 >>= 2
+    # x3 = (c >> 4) + ((d & 0x3f) << 4)
+    np.bitwise_and(d, 0x3f, out=x3)
+    x3 <<= 8
+    x3 |= c
+    x3 >>= 4
+    # x4 = (d >> 6) + (e << 2)
+    np.copyto(x4, e)
+    x4 <<= 8
+    x4 |= d
+    x4 >>= 6
+
+def _unpack_mipiraw(src, out):
+    src = src.reshape(src.shape[0], -1, 5)
+    dst = out.reshape(out.shape[0], -1, 4)
+    a, b, c, d, e = [src[..., x] for x in range(5)]
+    x1, x2, x3, x4 = [dst[..., x] for x in range(4)]
+    # x1 = (a << 2) + (e & 0x03), x2 is scratch
+    np.left_shift(a, 2, out=x2, dtype=np.uint16)
+    np.bitwise_and(e, 0x03, out=x1)
+    x1 |= x2
+    # x2 = (b << 2) + ((e >> 2) & 0x03), x3 is scratch
+    np.left_shift(b, 2, out=x3, dtype=np.uint16)
+    np.right_shift(e, 2, out=x2, dtype=np.uint16)
+    x2 &= 0x03
+    x2 |= x3
+    # x3 = (c << 2) + ((e >> 4) & 0x03), x4 is scratch
+    np.left_shift(c, 2, out=x4, dtype=np.uint16)
+    np.right_shift(e, 4, out=x3, dtype=np.uint16)
+    x3 &= 0x03
+    x3 |= x4
+    # x4 = (d << 2) + (e >> 6)
+    np.copyto(x4, d)
+    x4 <<= 8
+    x4 |= e
+    x4 >>= 6
+
+def _pack_mipiraw(src, out, scratch=None):
+    """
+    Inverse of _unpack_mipiraw: 10-bit codes `src` (rows, width) uint16 ->
+    `out` (rows, width * 5 / 4) uint8, four MSB bytes then the packed LSBs.
+    `scratch` is an optional (rows, width / 4) uint16 buffer.
+    """
+    src = src.reshape(src.shape[0], -1, 4)
+    dst = out.reshape(out.shape[0], -1, 5)
+    if scratch is None:
+        scratch = np.empty(src.shape[:2], dtype=np.uint16)
+    e = dst[..., 4]
+    np.bitwise_and(src[..., 0], 0x03, out=e, casting='unsafe')
+    for k in range(4):
+        x = src[..., k]
+        np.right_shift(x, 2, out=dst[..., k], casting='unsafe')
+        if k:
+            np.bitwise_and(x, 0x03, out=scratch)
+            scratch <<= 2 * k
+            np.bitwise_or(e, scratch, out=e, casting='unsafe')
+
+def _unpack_raw10p(src, out):
+    raw16 = src.view(np.dtype('<u2'))
+    np.bitwise_and(raw16, 0x3FF, out=out)
+
+def _unpack_copy(src, out):
+    np.copyto(out, src)
+
+# name: (unpacker, significant bits, pixels per source element)
+UNPACK_ENGINES = {
+    'raw10':  (_unpack_raw10, 10, 0.8),
+    'mipi':   (_unpack_mipiraw, 10, 0.8),
+    'raw10p': (_unpack_raw10p, 10, 0.5),
+    'raw8':   (_unpack_copy, 8, 1.0),
+    'raw16':  (_unpack_copy, 16, 1.0),
+    'code10': (_unpack_copy, 10, 1.0),  # already unpacked 10-bit codes (rawz)
+}
+
+# RawBayerImage.load dtype policies; 'float64' is the legacy rawtorawf path
+DTYPE_POLICIES = ('float64', 'float32', 'uint16')
+
+UNPACK_CHUNK_ROWS = 128
+
+# Streaming decode: default strip height and halo rows on each side. The halo
+# covers the 3x3 demosaic kernel and is kept even so every strip starts on the
+# same Bayer phase as the full frame.
+STRIP_ROWS = 256
+STRIP_HALO = 2
+
+def unpack_scale(engine, black=0):
+    """Factor that maps black-subtracted codes of `engine` onto [0, 1]."""
+    bits = UNPACK_ENGINES[engine][1]
+    return 1.0 / np.float64(2**bits - black)
+
+def unpack_bayer(raw, h, engine, dtype=np.uint16, black=0, scale=None, out=None):
+    """
+    Unpack a packed Bayer buffer into an (h, w) mosaic.
+    dtype=uint16 returns black-subtracted integer codes; a float dtype also
+    applies `scale` (default unpack_scale()) and converts in row chunks so
+    the full-frame uint16 intermediate is never allocated.
+    """
+    unpacker, bits, ppu = UNPACK_ENGINES[engine]
+    src = raw.reshape(h, -1)
+    w = int(src.shape[1] * ppu)
+    dtype = np.dtype(dtype)
+    if out is None:
+        out = np.empty((h, w), dtype=dtype)
+
+    def _unpack_rows(s, o):
+        unpacker(s, o)
+        if black:
+            np.maximum(o, black, out=o)
+            o -= black
+
+    if dtype == np.uint16:
+        _unpack_rows(src, out)
+        return out
 
-def yuv420torgb(yuv, h, isYvu=False):
-    yuv = yuv.astype(np.int32)
+    if scale is None:
+        scale = unpack_scale(engine, black)
+    tmp = np.empty((min(UNPACK_CHUNK_ROWS, h), w), dtype=np.uint16)
+    for r0 in range(0, h, UNPACK_CHUNK_ROWS):
+        r1 = min(r0 + UNPACK_CHUNK_ROWS, h)
+        t = tmp[:r1 - r0]
+        _unpack_rows(src[r0:r1], t)
+        np.multiply(t, scale, out=out[r0:r1], dtype=dtype)
+    return out
 
+def repack_mipi(src_path, dst_path, width, height, offset=0, strip_rows=STRIP_ROWS):
+    """
+    Convert a raw10p frame (10 bits in 16-bit words, see Raw10PaddedImage)
+    into packed MIPI RAW10 (5 bytes per 4 pixels, read back by MipiRawImage)
+    in strips of `strip_rows` rows, so only one strip is ever in memory.
+    Returns the number of bytes written.
+    """
+    if width % 4:
+        raise ValueError("packed RAW10 needs a width multiple of 4")
+    src = Raw10PaddedImage(src_path, width, height, offset)
+    rows = min(strip_rows, height)
+    codes = np.empty((rows, width), dtype=np.uint16)
+    packed = np.empty((rows, width * 5 // 4), dtype=np.uint8)
+    scratch = np.empty((rows, width // 4), dtype=np.uint16)
+    tmp = dst_path + '.tmp'
+    with open(tmp, 'wb') as f:
+        for r0 in range(0, height, rows):
+            n = min(rows, height - r0)
+            _unpack_raw10p(src.readRows(r0, r0 + n).reshape(n, -1), codes[:n])
+            _pack_mipiraw(codes[:n], packed[:n], scratch[:n])
+            packed[:n].tofile(f)
+    os.replace(tmp, dst_path)
+    return height * width * 5 // 4
+
+# ---------------------------------------------------------------------------
+# YUV 4:2:0 (NV12 / NV21, BT.601 limited range)
+#
+# Chroma is never upsampled into full-size planes: the output is viewed as
+# (h/2, 2, w/2, 2, 3) and the quarter-size chroma terms are broadcast over
+# each 2x2 block. Float math is float32, the RGB -> NV12 path is fixed point.
+# ---------------------------------------------------------------------------
+def _yuv_planes(yuv, h, isYvu=False):
+    """(y (h, w), u (h/2, w/2), v (h/2, w/2)) views of a flat 4:2:0 semi-planar buffer."""
     w = int(yuv.size / (h * 1.5))
-    y = yuv[0:w*h]
-    # u,v size is  h/2 * w/2
-    if isYvu:
-        v = yuv[w*h::2]
-        u = yuv[w*h+1::2]
+    y = yuv[:w * h].reshape(h, w)
+    uv = yuv[w * h:w * h + w * h // 2].reshape(h // 2, w // 2, 2)
+    u, v = (uv[..., 1], uv[..., 0]) if isYvu else (uv[..., 0], uv[..., 1])
+    return y, u, v
+
+def yuv420torgb(yuv, h, isYvu=False, out=None, half=False):
+    """
+    NV12 (NV21 with isYvu) -> float32 RGB in [0, 1] (codes / 256 as before),
+    written into `out` when given. half=True converts at chroma resolution
+    (h/2, w/2) with the luma of each 2x2 block averaged.
+    """
+    y, u, v = _yuv_planes(yuv, h, isYvu)
+    h2, w2 = u.shape
+    shape = (h2, w2, 3) if half else (h2 * 2, w2 * 2, 3)
+    if out is None:
+        out = np.empty(shape, dtype=np.float32)
+    elif out.shape != shape:
+        raise ValueError("out must be a %s frame" % (shape,))
+
+    # chroma terms at quarter size
+    uf = np.subtract(u, np.float32(128), dtype=np.float32)
+    vf = np.subtract(v, np.float32(128), dtype=np.float32)
+    cr = vf * np.float32(1.596)
+    cb = uf * np.float32(2.018)
+    vf *= np.float32(-0.813)
+    uf *= np.float32(-0.391)
+    cg = np.add(vf, uf, out=vf)
+
+    if half:
+        o = out
+        lum = o[..., 1]
+        q = y[:2 * h2, :2 * w2].reshape(h2, 2, w2, 2)
+        np.add(q[:, 0, :, 0], q[:, 0, :, 1], out=lum, dtype=np.float32)
+        lum += q[:, 1, :, 0]
+        lum += q[:, 1, :, 1]
+        lum *= np.float32(0.25)
     else:
-        u = yuv[w*h::2]
-        v = yuv[w*h+1::2]
+        o = out.reshape(h2, 2, w2, 2, 3)
+        lum = o[..., 1]
+        np.copyto(lum, y.reshape(h2, 2, w2, 2), casting='unsafe')
+        cr, cg, cb = [c[:, None, :, None] for c in (cr, cg, cb)]
+    lum -= np.float32(16)
+    lum *= np.float32(1.164)
+    np.add(lum, cr, out=o[..., 0])
+    np.add(lum, cb, out=o[..., 2])
+    lum += cg
+    np.clip(out, 0, 256, out=out)
+    out *= np.float32(1 / 256.0)
+    return out
 
-    # u,v size is  h/2 * w
-    u = np.stack((u,u), axis=1).flatten()
-    v = np.stack((v,v), axis=1).flatten()
+def rgbtonv12(rgb8, out=None, isYvu=False):
+    """
+    uint8 (h, w, 3) RGB -> flat NV12 (NV21 with isYvu) buffer of h * w * 3/2
+    bytes, written into `out` when given. Fixed-point BT.601 coefficients
+    (x 256), chroma from the rounded 2x2 mean of each block.
+    """
+    h, w, _ = rgb8.shape
+    if h % 2 or w % 2:
+        raise ValueError("NV12 needs an even frame size")
+    if out is None:
+        out = np.empty(h * w * 3 // 2, dtype=np.uint8)
+    elif out.size != h * w * 3 // 2 or out.dtype != np.uint8:
+        raise ValueError("out must be a uint8 buffer of %d bytes" % (h * w * 3 // 2))
+    y, u, v = _yuv_planes(out, h, isYvu)
+
+    def mix(src, kr, kg, kb, bias, dst):
+        acc = np.multiply(src[..., 0], kr, dtype=np.int32)
+        t = np.multiply(src[..., 1], kg, dtype=np.int32)
+        acc += t
+        np.multiply(src[..., 2], kb, out=t, dtype=np.int32)
+        acc += t
+        acc += bias
+        acc >>= 8
+        np.clip(acc, 0, 255, out=acc)
+        np.copyto(dst, acc, casting='unsafe')
+
+    # row chunks keep the int32 accumulators small
+    for r0 in range(0, h, UNPACK_CHUNK_ROWS):
+        r1 = min(r0 + UNPACK_CHUNK_ROWS, h)
+        mix(rgb8[r0:r1], 66, 129, 25, (16 << 8) + 128, y[r0:r1])
+    quads = bin2x2(rgb8)
+    mix(quads, -38, -74, 112, (128 << 8) + 128, u)
+    mix(quads, 112, -94, -18, (128 << 8) + 128, v)
+    return out
+
+# ---------------------------------------------------------------------------
+# Colour stage
+# ---------------------------------------------------------------------------
+LUT_SIZE = 1024                 # 10-bit LUT index
+
+DEFAULT_CCM = np.array([[1.2085, -0.2502, 0.0417],
+                        [-0.1174, 1.1625, -0.0452],
+                        [0.0226, -0.2524, 1.2298]])
+
+class ColorPipeline(object):
+    """
+    Fused colour stage for linear RGB in [0, 1]: digital gain, optional 3x3
+    CCM and gamma, quantised to uint8 through a LUT_SIZE-entry table. The
+    gain is folded into the LUT index scale (or into the CCM), so besides
+    the optional CCM product the only temporary is the uint16 index array.
+    """
+    def __init__(self, gain=1.0, ccm=None, gamma=1.0):
+        self.gain = gain
+        self.ccm = None if ccm is None else np.asarray(ccm, dtype=np.float32)
+        self.gamma = gamma
+        x = np.arange(LUT_SIZE, dtype=np.float64) / (LUT_SIZE - 1)
+        if gamma != 1.0:
+            x **= 1.0 / gamma
+        self.lut = (x * 255).astype(np.uint8)
+
+    def apply(self, rgb, out=None):
+        """
+        Linear float rgb (..., 3) -> uint8, written into `out` when given.
+        `rgb` is used as scratch and is overwritten.
+        """
+        k = self.gain * (LUT_SIZE - 1)
+        if self.ccm is None:
+            rgb *= k
+        else:
+            rgb = np.matmul(rgb, (self.ccm * k).T.astype(rgb.dtype))
+        np.clip(rgb, 0, LUT_SIZE - 1, out=rgb)
+        idx = np.empty(rgb.shape, dtype=np.uint16)
+        np.add(rgb, 0.5, out=idx, casting='unsafe')
+        if out is None:
+            out = np.empty(rgb.shape, dtype=np.uint8)
+        np.take(self.lut, idx, out=out, mode='clip')
+        return out
+
+# ---------------------------------------------------------------------------
+# Output pyramid
+# ---------------------------------------------------------------------------
+PYRAMID_THUMB = 16              # thumbnail level (1/16 of the raw size)
+
+def bin2x2(frame):
+    """2x2 box binning of a uint8 (h, w, c) frame with rounding, odd edges dropped."""
+    h, w = frame.shape[0] // 2, frame.shape[1] // 2
+    quads = frame[:2 * h, :2 * w].reshape(h, 2, w, 2, -1)
+    # row pairs then column pairs; plain ufunc adds are much faster than sum(axis=(1, 3))
+    rows = np.add(quads[:, 0], quads[:, 1], dtype=np.uint16)
+    acc = np.add(rows[:, :, 0], rows[:, :, 1])
+    del rows
+    acc += 2
+    acc >>= 2
+    return acc.astype(np.uint8)
+
+def build_pyramid(frame, levels=(1, 2, 4, PYRAMID_THUMB), base=1):
+    """
+    {divisor: frame} for the requested levels, divisors relative to the raw
+    size. `frame` is level `base` (2 when the 'half' engine already binned
+    the Bayer quads); every further level is binned from the previous one,
+    so all products come from a single decode.
+    """
+    pyramid = {}
+    level, cur = base, frame
+    top = max(levels)
+    while True:
+        if level in levels:
+            pyramid[level] = cur
+        if level >= top:
+            break
+        cur = bin2x2(cur)
+        level *= 2
+    missing = sorted(set(levels) - set(pyramid))
+    if missing:
+        raise ValueError("pyramid levels must be powers of two of %d: %s" % (base, missing))
+    return pyramid
+
+# ---------------------------------------------------------------------------
+# Quicklook
+# ---------------------------------------------------------------------------
+QUICKLOOK_BINS = 64             # histogram bins per channel (power of two)
+
+def bayer_stats(mosaic, bayer='rggb', bits=10, white=None, bins=QUICKLOOK_BINS):
+    """
+    Per-channel histograms of an integer mosaic of `bits`-bit codes and the
+    number of samples at or above `white` (default full scale). Returns
+    {'bins', 'white', 'r'|'g'|'b': {'hist', 'mean', 'saturated'}}.
+    """
+    if bins & (bins - 1) or bins > 2**bits:
+        raise ValueError("bins must be a power of two <= 2**bits")
+    if white is None:
+        white = 2**bits - 1
+    shift = bits - (bins.bit_length() - 1)
+    (ry, rx), (by, bx) = BAYER_OFFSETS[bayer]
+    planes = {
+        'r': [mosaic[ry::2, rx::2]],
+        'g': [mosaic[ry::2, bx::2], mosaic[by::2, rx::2]],
+        'b': [mosaic[by::2, bx::2]],
+    }
+    stats = {'bins': bins, 'white': int(white)}
+    for name, views in planes.items():
+        hist = np.zeros(bins, dtype=np.int64)
+        total = saturated = 0
+        for v in views:
+            v = v.ravel()
+            hist += np.bincount(v >> shift, minlength=bins)[:bins]
+            saturated += int(np.count_nonzero(v >= white))
+            total += int(v.sum(dtype=np.int64))
+        n = int(hist.sum())
+        stats[name] = {'hist': hist.tolist(), 'mean': total / n if n else 0.0,
+                       'saturated': saturated}
+    return stats
+
+# ---------------------------------------------------------------------------
+# Raw archive (.rawz)
+#
+# Lossless container of a Bayer frame in independently compressed blocks of
+# RAWZ_BLOCK_ROWS rows. In every block the four quad sites are split into
+# planes, each row is delta coded from its left neighbour (so the predictor
+# is the nearest same colour sample), the deltas are zigzag mapped and
+# stored as a low byte plane followed by a high byte plane before zlib/lzma.
+# Layout: header, block table (offset, size) per block, blocks.
+# ---------------------------------------------------------------------------
+RAWZ_MAGIC = b'RAWZ'
+RAWZ_VERSION = 1
+RAWZ_HEADER = struct.Struct('<4sBBHHB4sHI')   # magic, version, codec, w, h, bits, bayer, block rows, blocks
+RAWZ_ENTRY = struct.Struct('<QI')
+RAWZ_BLOCK_ROWS = 64
+RAWZ_CODECS = {'zlib': 0, 'lzma': 1}
+RAWZ_ENGINES = {8: 'raw8', 10: 'code10', 16: 'raw16'}
+
+def _rawz_encode_block(codes, codec, level):
+    """uint16 (rows, w) block -> compressed bytes."""
+    planes = [codes[dy::2, dx::2] for dy in (0, 1) for dx in (0, 1)]
+    z = np.empty((4,) + planes[0].shape, dtype=np.uint16)
+    for p, d in zip(planes, z):
+        d[:, 0] = p[:, 0]
+        np.subtract(p[:, 1:], p[:, :-1], out=d[:, 1:])
+        # zigzag: small negative deltas become small odd codes
+        sign = (d >> 15).astype(np.uint16)
+        np.negative(sign, out=sign)
+        d <<= 1
+        d ^= sign
+    # low bytes, then high bytes, independent of the host byte order
+    buf = z.astype('<u2', copy=False).view(np.uint8).reshape(-1, 2).T.tobytes()
+    if codec == 'lzma':
+        return lzma.compress(buf, preset=6 if level is None else level)
+    return zlib.compress(buf, 6 if level is None else level)
+
+def _rawz_decode_block(data, rows, w, codec):
+    """Compressed bytes -> uint16 (rows, w) block."""
+    buf = lzma.decompress(data) if codec == 'lzma' else zlib.decompress(data)
+    z = np.empty((4, rows // 2, w // 2), dtype='<u2')
+    b = np.frombuffer(buf, dtype=np.uint8).reshape(2, -1)
+    zb = z.view(np.uint8).reshape(-1, 2)
+    zb[:, 0] = b[0]
+    zb[:, 1] = b[1]
+    z = z.astype(np.uint16, copy=False)
+    sign = z & 1
+    np.negative(sign, out=sign)
+    z >>= 1
+    z ^= sign
+    out = np.empty((rows, w), dtype=np.uint16)
+    sites = [(dy, dx) for dy in (0, 1) for dx in (0, 1)]
+    for (dy, dx), d in zip(sites, z):
+        np.cumsum(d, axis=1, dtype=np.uint16, out=out[dy::2, dx::2])
+    return out
+
+def write_rawz(img, path, codec='zlib', level=None, block_rows=RAWZ_BLOCK_ROWS, workers=1):
+    """
+    Archive the frame of RawBayerImage `img` (black level not subtracted)
+    as .rawz, one block of `block_rows` rows at a time; workers > 1
+    compresses blocks on a thread pool (zlib/lzma release the GIL).
+    Returns the file size.
+    """
+    if codec not in RAWZ_CODECS:
+        raise ValueError("Unsupported rawz codec: %s" % codec)
+    if block_rows <= 0 or block_rows % 2 or img.height % 2 or img.width % 2:
+        raise ValueError("rawz needs even block rows and frame size")
+    bits = UNPACK_ENGINES[img.unpack][1]
+    blocks = [(r0, min(r0 + block_rows, img.height)) for r0 in range(0, img.height, block_rows)]
 
-    # u,v size is h * w
-    u.resize(int(h/2), w)
-    u = np.stack((u,u), axis=1).flatten()
-    v.resize(int(h/2), w)
-    v = np.stack((v,v), axis=1).flatten()
+    def encode(block):
+        r0, r1 = block
+        codes = unpack_bayer(img.readRows(r0, r1), r1 - r0, img.unpack)
+        return _rawz_encode_block(codes, codec, level)
 
-    b = 1.164 * (y-16) + 2.018 * (u - 128)
-    g = 1.164 * (y-16) - 0.813 * (v - 128) - 0.391 * (u - 128)
-    r = 1.164 * (y-16) + 1.596 * (v - 128)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(RAWZ_HEADER.pack(RAWZ_MAGIC, RAWZ_VERSION, RAWZ_CODECS[codec], img.width,
+                                 img.height, bits, img.bayer.encode(), block_rows, len(blocks)))
+        table_pos = f.tell()
+        f.write(b'\0' * RAWZ_ENTRY.size * len(blocks))
+        table = []
+        # at most `workers` blocks in flight, written in order
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+            for i in range(0, len(blocks), max(workers, 1)):
+                for data in pool.map(encode, blocks[i:i + max(workers, 1)]):
+                    table.append((f.tell(), len(data)))
+                    f.write(data)
+        size = f.tell()
+        f.seek(table_pos)
+        f.write(b''.join(RAWZ_ENTRY.pack(*e) for e in table))
+    os.replace(tmp, path)
+    return size
 
-    rgb = np.stack((r,g,b), axis=1)
-    np.clip(rgb, 0, 256, out=rgb)
-    rgb = rgb/256.0
-    return rgb.reshape(h, w, 3)
+def read_rawz_header(path):
+    """Header of a .rawz file as a dict, including the block table."""
+    with open(path, 'rb') as f:
+        fields = RAWZ_HEADER.unpack(f.read(RAWZ_HEADER.size))
+        magic, version, codec, w, h, bits, bayer, block_rows, nblocks = fields
+        if magic != RAWZ_MAGIC or version != RAWZ_VERSION:
+            raise ValueError("%s is not a rawz v%d file" % (path, RAWZ_VERSION))
+        table = [RAWZ_ENTRY.unpack(f.read(RAWZ_ENTRY.size)) for _ in range(nblocks)]
+    codecs = {v: k for k, v in RAWZ_CODECS.items()}
+    return {'codec': codecs[codec], 'width': w, 'height': h, 'bits': bits,
+            'bayer': bayer.decode(), 'block_rows': block_rows, 'blocks': table}
 
 class RawImageBase(object):
     def __init__(self, path, width, height, usize=None, offset=0, dtype=np.uint8):
@@ -166,9 +923,45 @@ class RawImageBase(object):
         self.dtype = dtype
         self.raw = None
         self.rgb = None
+        self.mm = None
+        # In-memory frame (bytes-like, e.g. a dequeued V4L2 mmap buffer)
+        # decoded instead of the file at `path`, which is then only a name
+        self.buffer = None
         pass
 
+    def map(self):
+        """
+        Read-only np.memmap of the frame as (height, row units). Pages are
+        only read when touched. Returns None when the geometry is unknown or
+        the file is shorter than one frame (load() then zero pads instead).
+        With self.buffer set it is a view of the buffer instead.
+        """
+        if self.mm is not None:
+            return self.mm
+        if self.width is None or self.usize is None or self.height is None:
+            return None
+        units = int(self.width * self.usize) // np.dtype(self.dtype).itemsize
+        if self.buffer is not None:
+            count = units * self.height
+            size = memoryview(self.buffer).nbytes - self.offset
+            if size // np.dtype(self.dtype).itemsize < count:
+                raise ValueError("buffer is shorter than one %dx%d frame" % (self.width, self.height))
+            self.mm = np.frombuffer(self.buffer, dtype=self.dtype, count=count,
+                                    offset=self.offset).reshape(self.height, units)
+            return self.mm
+        avail = (os.path.getsize(self.path) - self.offset) // np.dtype(self.dtype).itemsize
+        if avail < units * self.height:
+            return None
+        self.mm = np.memmap(self.path, dtype=self.dtype, mode='r',
+                            offset=self.offset, shape=(self.height, units))
+        return self.mm
+
     def load(self):
+        mm = self.map()
+        if mm is not None:
+            self.raw = mm.reshape(-1)
+            return
+
         # 1. open file
         with open(self.path, 'rb') as infile:
             # 2. skip offset
@@ -186,32 +979,279 @@ class RawImageBase(object):
         return self.rgb
 
 class RawBayerImage(RawImageBase):
-    def __init__(self, path, width, height, usize, offset, dtype, bayer='rggb', rawtorawf=None):
+    def __init__(self, path, width, height, usize, offset, dtype, bayer='rggb', rawtorawf=None,
+                 unpack=None, black=0):
         RawImageBase.__init__(self, path=path, width=width,
                               height=height, usize=usize,
                               offset=offset, dtype=dtype)
         self.bayer = bayer
         self.rawtorawf = rawtorawf
+        self.unpack = unpack
+        self.black = black
+        # WB / digital gains for the per-channel normalised demosaic engines.
+        # They reproduce the look of the former mask demosaic (rgain 4.0,
+        # bgain 2.7, dgain 1.2), which left R/B at 1/4 and G at 1/2 scale.
+        self.rgain = 2.0
+        self.bgain = 1.35
+        self.dgain = 0.6
+        # 'fixed' uses rgain/bgain, otherwise gains are estimated per frame
+        # (or taken from awbCache for `camera`)
+        self.awb = 'fixed'
+        self.camera = None
+        self.awbCache = None
+        # ColorPipeline for the 8-bit outputs, None = plain dgain
+        self.color = None
+        self.mosaic = None
+        # StageProfiler of the decode, None = not profiled
+        self.profiler = None
 
+    def _stage(self, name):
+        return profile_stage(self.profiler, name)
 
-    def load(self):
+    def loadRaw(self):
+        """Fill self.raw with the whole packed frame."""
         RawImageBase.load(self)
-        rawf = self.rawtorawf(self.raw, self.height)
-        rawf = rawfAwb(rawf, 4.0, 2.7, self.bayer)  # Bước 4
-        self.rgb = demosaic_bilinear(rawf, self.bayer)
-        
-        # THÊM ĐOẠN NÀY:
-        # Color correction matrix
-        self.rgb = self.rgb * 1.2
+
+    def unpackMosaic(self, dtype=np.uint16):
+        return unpack_bayer(self.raw, self.height, self.unpack,
+                            dtype=dtype, black=self.black)
+
+    def _rawf(self, raw, h, dtype):
+        """Returns (mosaic, scale) for the dtype policy."""
+        if dtype not in DTYPE_POLICIES:
+            raise ValueError("Unsupported dtype policy: %s" % dtype)
+        with self._stage('unpack'):
+            if self.unpack is None or (dtype == 'float64' and self.rawtorawf is not None):
+                return self.rawtorawf(raw, h), 1.0
+            if dtype != 'uint16':
+                return unpack_bayer(raw, h, self.unpack, np.dtype(dtype), self.black), 1.0
+            mosaic = unpack_bayer(raw, h, self.unpack, np.uint16, self.black)
+            return mosaic, unpack_scale(self.unpack, self.black)
+
+    def _packedRows(self, r0, r1):
+        if self.raw is None:
+            return self.readRows(r0, r1)
+        units = self.raw.size // self.height
+        return self.raw[r0 * units:r1 * units]
+
+    def sampleMosaic(self, step=AWB_STEP):
+        """uint16 mosaic made of every `step`-th Bayer quad in both directions."""
+        q = 2 * step
+        w = self.width - self.width % q
+        rows = []
+        for r in range(0, self.height - 1, q):
+            m = unpack_bayer(self._packedRows(r, r + 2), 2, self.unpack, black=self.black)
+            rows.append(m[:, :w].reshape(2, -1, q)[:, :, :2].reshape(2, -1))
+        return np.vstack(rows)
+
+    def wbGains(self, sample=None):
+        """
+        (rgain, bgain) for self.awb, estimated and cached per camera when
+        automatic. `sample` is an already taken sampleMosaic() to estimate from.
+        """
+        if self.awb == 'fixed' or self.unpack is None:
+            return self.rgain, self.bgain
+        cache = self.awbCache if self.camera is not None else None
+        gains = cache.get(self.camera, self.awb) if cache else None
+        if gains is None:
+            white = 2**UNPACK_ENGINES[self.unpack][1] - 1 - self.black
+            with self._stage('awb_estimate'):
+                if sample is None:
+                    sample = self.sampleMosaic()
+                gains = awb_estimate(sample, self.bayer, self.awb, step=1, white=white)
+            if cache:
+                cache.put(self.camera, self.awb, *gains)
+        return gains
+
+    def quicklook(self, scale=PYRAMID_THUMB, bins=QUICKLOOK_BINS):
+        """
+        Cheap preview without a full decode: one Bayer quad every scale/2
+        quads is unpacked (only those rows of the memmap are touched) and
+        binned to a 1/scale RGB thumbnail. Returns (rgb8, stats), stats
+        being bayer_stats() of the sampled codes before white balance.
+        """
+        if scale < 2 or scale % 2:
+            raise ValueError("quicklook scale must be an even number >= 2")
+        bits = UNPACK_ENGINES[self.unpack][1]
+        with self._stage('sample'):
+            sample = self.sampleMosaic(step=scale // 2)
+            stats = bayer_stats(sample, self.bayer, bits, 2**bits - 1 - self.black, bins)
+        stats['scale'] = scale
+        gains = self.wbGains(sample if scale // 2 == AWB_STEP else None)
+        stats['gains'] = [float(g) for g in gains]
+        rgb = self._develop(sample, unpack_scale(self.unpack, self.black), 'half', gains)
+        with self._stage('color'):
+            return self.colorStage().apply(rgb), stats
+
+    def _develop(self, mosaic, scale=1.0, engine='bilinear', gains=None):
+        """AWB + demosaic, returns linear RGB (no digital gain)."""
+        rgain, bgain = gains if gains else (self.rgain, self.bgain)
+        with self._stage('awb'):
+            awb_apply(mosaic, rgain, bgain, self.bayer)  # Bước 4
+        with self._stage('demosaic'):
+            return demosaic(mosaic, self.bayer, engine, scale, clip=False)
+
+    def colorStage(self):
+        return self.color if self.color is not None else ColorPipeline(self.dgain)
+
+    def load(self, dtype='float64', engine='bilinear'):
+        """
+        dtype policy:
+          'float64' : legacy rawtorawf path (float64 mosaic), the unpack
+                      engine in float64 for classes without one (rawz)
+          'float32' : integer unpack engine, converted to float32 in row chunks
+          'uint16'  : integer unpack engine, the white balanced uint16 mosaic
+                      is demosaiced directly and kept in self.mosaic
+        engine: demosaic engine name from DEMOSAIC_ENGINES
+        """
+        with self._stage('read'):
+            self.loadRaw()
+        gains = self.wbGains()
+        mosaic, scale = self._rawf(self.raw, self.height, dtype)
+        self.raw = None
+        if dtype == 'uint16':
+            self.mosaic = mosaic
+        self.rgb = self._develop(mosaic, scale, engine, gains)
+        with self._stage('gain'):
+            self.rgb *= self.dgain
         # self.rgb = np.clip(self.rgb, 0.0, 1.0)
 
+    def readRows(self, r0, r1):
+        """Packed rows [r0, r1) from the memmap, or read from file and zero padded."""
+        mm = self.map()
+        if mm is not None:
+            return mm[r0:r1].reshape(-1)
+        row_bytes = int(self.width * self.usize)
+        count = (r1 - r0) * row_bytes // np.dtype(self.dtype).itemsize
+        with open(self.path, 'rb') as infile:
+            infile.seek(self.offset + r0 * row_bytes)
+            raw = np.fromfile(infile, self.dtype, count=count)
+        if raw.size < count:
+            raw.resize(count)
+        return raw
+
+    def _decodeBand(self, r0, r1, dtype, engine, gains, color, frame=None):
+        """
+        Decode raw rows [r0, r1) with a STRIP_HALO halo, returns (out row, rgb8).
+        With `frame` the colour stage writes straight into its rows.
+        """
+        h = self.height
+        d = DEMOSAIC_ENGINES[engine][1]
+        h0 = max(r0 - STRIP_HALO, 0)
+        h1 = min(r1 + STRIP_HALO, h)
+        with self._stage('read'):
+            raw = self.readRows(h0, h1)
+        mosaic, scale = self._rawf(raw, h1 - h0, dtype)
+        rgb = self._develop(mosaic, scale, engine, gains)[(r0 - h0) // d:(r1 - h0) // d]
+        out = frame[r0 // d:r0 // d + rgb.shape[0]] if frame is not None else None
+        with self._stage('color'):
+            return r0 // d, color.apply(rgb, out)
+
+    def _bands(self, strip_rows):
+        if strip_rows <= 0 or strip_rows % 2:
+            raise ValueError("strip_rows must be a positive even number")
+        return [(r0, min(r0 + strip_rows, self.height))
+                for r0 in range(0, self.height, strip_rows)]
+
+    def strips(self, strip_rows=STRIP_ROWS, dtype='float32', engine='bilinear'):
+        """
+        Streaming decode. Yields (row, rgb8) for consecutive horizontal
+        strips of `strip_rows` raw rows: each strip is read with STRIP_HALO extra
+        rows on both sides, goes through unpack -> AWB -> demosaic -> colour
+        stage (gain, CCM, gamma, uint8 LUT) and the halo is dropped. Peak memory is bounded by the
+        strip height; the full-frame float RGB is never allocated. With a
+        downscaling engine `row` and the strip are in output coordinates.
+        """
+        bands = self._bands(strip_rows)
+        gains = self.wbGains()
+        color = self.colorStage()
+        for r0, r1 in bands:
+            yield self._decodeBand(r0, r1, dtype, engine, gains, color)
+
+    def loadStrips(self, consumer=None, strip_rows=STRIP_ROWS, dtype='float32', engine='bilinear',
+                   workers=1, out=None):
+        """
+        Run strips() and hand every strip to consumer(row, rgb8). Without a
+        consumer the strips are assembled into a uint8 (h, w, 3) frame which
+        is returned; `out` is a preallocated frame to reuse.
+        workers > 1 decodes the strips as row bands on a thread pool (NumPy
+        releases the GIL in the heavy loops); the consumer is then called
+        from the worker threads, in any order. At most `workers` bands are
+        in flight, so peak memory is workers x one strip.
+        """
+        frame = None
+        if consumer is None:
+            d = DEMOSAIC_ENGINES[engine][1]
+            shape = (self.height // d, self.width // d, 3)
+            if out is None:
+                out = np.empty(shape, dtype=np.uint8)
+            elif out.shape != shape or out.dtype != np.uint8:
+                raise ValueError("out must be a uint8 %s frame" % (shape,))
+            frame = out
+
+        bands = self._bands(strip_rows)
+        gains = self.wbGains()
+        color = self.colorStage()
+        def work(band):
+            row, rgb8 = self._decodeBand(band[0], band[1], dtype, engine, gains, color, frame)
+            if consumer is not None:
+                consumer(row, rgb8)
+        if workers <= 1:
+            for band in bands:
+                work(band)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for _ in pool.map(work, bands):
+                    pass
+        return frame
+
+    def colAlign(self):
+        """Column alignment of a ROI: Bayer quad and packing group (4 px for raw10/mipi)."""
+        return 4 if UNPACK_ENGINES[self.unpack][2] == 0.8 else 2
+
+    def roiBox(self, top, bottom, left, right):
+        """Snap a ROI outwards to Bayer quads / packing groups, clamped to the frame."""
+        a = self.colAlign()
+        top = max(top - top % 2, 0)
+        left = max(left - left % a, 0)
+        bottom = min(bottom + bottom % 2, self.height)
+        right = min(right + (-right) % a, self.width)
+        return top, bottom, left, right
+
+    def loadRoi(self, top, bottom, left, right, dtype='float32', engine='bilinear'):
+        """
+        Decode only rows [top, bottom) and columns [left, right). The window
+        is snapped with roiBox() and read with a demosaic halo from the
+        memmap, so only the pages under it are touched. The result equals
+        the same crop of a full decode. Returns (box, rgb8), box being the
+        snapped (top, bottom, left, right) in raw pixels.
+        """
+        top, bottom, left, right = self.roiBox(top, bottom, left, right)
+        a = self.colAlign()
+        halo_c = STRIP_HALO + (-STRIP_HALO) % a
+        h0, h1 = max(top - STRIP_HALO, 0), min(bottom + STRIP_HALO, self.height)
+        c0, c1 = max(left - halo_c, 0), min(right + halo_c, self.width)
+        ppu = UNPACK_ENGINES[self.unpack][2]
+
+        with self._stage('read'):
+            mm = self.map()
+            rows = mm[h0:h1] if mm is not None else self.readRows(h0, h1).reshape(h1 - h0, -1)
+            src = np.ascontiguousarray(rows[:, int(c0 / ppu):int(c1 / ppu)])
+        mosaic, scale = self._rawf(src, h1 - h0, dtype)
+        d = DEMOSAIC_ENGINES[engine][1]
+        rgb = self._develop(mosaic, scale, engine, self.wbGains())
+        rgb = rgb[(top - h0) // d:(bottom - h0) // d, (left - c0) // d:(right - c0) // d]
+        with self._stage('color'):
+            return (top, bottom, left, right), self.colorStage().apply(rgb)
+
 
 class Raw10Image(RawBayerImage):
     def __init__(self, path, width, height, offset=0, bayer='rggb'):
         RawBayerImage.__init__(self, path=path, width=width,
                               height=height, usize=1.25,
                               offset=offset, bayer=bayer,
-                              dtype=np.uint8, rawtorawf=raw10torawf)
+                              dtype=np.uint8, rawtorawf=raw10torawf,
+                              unpack='raw10')
 
 
 class MipiRawImage(RawBayerImage):
@@ -219,29 +1259,83 @@ class MipiRawImage(RawBayerImage):
         RawBayerImage.__init__(self, path=path, width=width,
                               height=height, usize=1.25,
                               offset=offset, bayer=bayer,
-                              dtype=np.uint8, rawtorawf=mipirawtorawf)
+                              dtype=np.uint8, rawtorawf=mipirawtorawf,
+                              unpack='mipi')
         
 class Raw10PaddedImage(RawBayerImage):
     def __init__(self, path, width, height, offset=0, bayer='rggb'):
         RawBayerImage.__init__(self, path=path, width=width,
                               height=height, usize=2.0,
                               offset=offset, bayer=bayer,
-                              dtype=np.uint8, rawtorawf=raw10ptorawf)
+                              dtype=np.uint8, rawtorawf=raw10ptorawf,
+                              unpack='raw10p')
 
 class Raw8Image(RawBayerImage):
     def __init__(self, path, width, height, offset=0, bayer='rggb'):
         RawBayerImage.__init__(self, path=path, width=width,
                               height=height, usize=1.0,
                               offset=offset, bayer=bayer,
-                              dtype=np.uint8, rawtorawf=raw8torawf)
+                              dtype=np.uint8, rawtorawf=raw8torawf,
+                              unpack='raw8')
 
 class Raw16Image(RawBayerImage):
     def __init__(self, path, width, height, offset=0, bayer='rggb'):
         RawBayerImage.__init__(self, path=path, width=width,
                               height=height, usize=2.0,
                               offset=offset, bayer=bayer,
-                              dtype=np.uint16, rawtorawf=raw16torawf)
+                              dtype=np.uint16, rawtorawf=raw16torawf,
+                              unpack='raw16')
+
+
+class RawzImage(RawBayerImage):
+    """
+    .rawz archive (see write_rawz). Geometry, Bayer pattern and bit depth
+    come from the header; readRows() only decompresses the row blocks it
+    touches, so loadRoi()/strips()/quicklook() work on part of the file.
+    """
+    def __init__(self, path, width=None, height=None, offset=0, bayer=None):
+        self.header = read_rawz_header(path)
+        hdr = self.header
+        if (width, height) not in ((None, None), (hdr['width'], hdr['height'])):
+            raise ValueError("%s is %dx%d" % (path, hdr['width'], hdr['height']))
+        if hdr['bits'] not in RAWZ_ENGINES:
+            raise ValueError("Unsupported rawz bit depth: %d" % hdr['bits'])
+        RawBayerImage.__init__(self, path=path, width=hdr['width'],
+                               height=hdr['height'], usize=2.0,
+                               offset=0, bayer=bayer or hdr['bayer'],
+                               dtype=np.uint16, unpack=RAWZ_ENGINES[hdr['bits']])
+        self._block = (None, None)  # last decoded (index, rows)
+
+    def map(self):
+        return None
+
+    def _blockRows(self, i):
+        cached_i, rows = self._block
+        if cached_i == i:
+            return rows
+        hdr = self.header
+        offset, size = hdr['blocks'][i]
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(size)
+        r0 = i * hdr['block_rows']
+        n = min(hdr['block_rows'], self.height - r0)
+        rows = _rawz_decode_block(data, n, self.width, hdr['codec'])
+        self._block = (i, rows)
+        return rows
+
+    def readRows(self, r0, r1):
+        """uint16 codes of rows [r0, r1), decoding only the blocks they span."""
+        br = self.header['block_rows']
+        parts = []
+        for i in range(r0 // br, (r1 - 1) // br + 1):
+            b0 = i * br
+            parts.append(self._blockRows(i)[max(r0 - b0, 0):r1 - b0])
+        rows = parts[0] if len(parts) == 1 else np.vstack(parts)
+        return rows.reshape(-1)
 
+    def loadRaw(self):
+        self.raw = self.readRows(0, self.height)
 
 class GrayImage(RawImageBase):
     def __init__(self, path, width, height, offset=0):
@@ -251,7 +1345,7 @@ class GrayImage(RawImageBase):
 
     def load(self):
         RawImageBase.load(self)
-        raw = self.raw / np.float(2**8)
+        raw = self.raw / np.float64(2**8)
         self.rgb = raw.reshape(self.height, -1)
 
 
@@ -2,10 +2,9 @@
 import sys
 import argparse
 import os
-import numpy as np
-from PIL import Image
-from raw_decoder import Raw10PaddedImage
-import gc, time
+import json
+import socket
+import gc, time, re
 
 # ===== Config dễ chỉnh ở đây =====
 CROP_TOP = 0.0
@@ -14,7 +13,142 @@ CROP_LEFT = 0.0
 CROP_RIGHT = 0.5
 # =================================
 
-def main():
+# Resident conversion service (raw_service.py)
+SERVICE_SOCKET = "/run/raw_service.sock"
+SERVICE_TIMEOUT = 120
+
+# Mirrors of raw_decoder.DEMOSAIC_ENGINES / AWB_METHODS, kept literal so the
+# thin client does not have to import numpy just to parse its arguments
+DEMOSAIC_CHOICES = ['bilinear', 'half', 'malvar']
+AWB_CHOICES = ['fixed', 'grayworld', 'whitepatch']
+
+# Output products written from the pyramid of the decoded frame:
+# name -> (pyramid level as a divisor of the raw size; JPEG options).
+# Levels finer than the decoded frame (-D half decodes at 1/2) use the
+# decoded frame itself.
+PRODUCTS = {
+    'high': (1, dict(quality=90, subsampling=0, optimize=False)),
+    'low': (4, dict(quality=60, subsampling=2, optimize=True)),
+    'thumb': (16, dict(quality=70, subsampling=2, optimize=True)),
+}
+
+# Quicklook product (-Q): thumbnail + channel statistics from a strided raw subsample
+QUICKLOOK_OPTS = dict(quality=70, subsampling=2, optimize=True)
+
+# Upper bound on the extra memory of concurrent encodes: each encode holds a
+# PIL copy of its (cropped) pyramid level, 4 bytes per pixel, plus the
+# libjpeg buffers (see encode_cost). A 5120x3840 high product alone costs
+# ~75 MiB (76 MiB measured peak), the budget lets high + low + thumb overlap.
+ENCODE_MEM_BUDGET = 96 << 20
+
+def crop_box(w, h):
+    """Crop window (left, top, right, bottom) of the low image from the CROP_* fractions."""
+    left = int(w * CROP_LEFT)
+    right = int(w * (1.0 - CROP_RIGHT))
+    top = int(h * CROP_TOP)
+    bottom = int(h * (1.0 - CROP_BOTTOM))
+    return left, top, right, bottom
+
+def encode_cost(shape, opts, budget=False, tile=0):
+    """
+    Worst-case extra bytes of one product encode of an (h, w) image (after
+    the crop): the PIL copy made by Image.fromarray (RGB is stored with 4
+    bytes per pixel) + the PIL/libjpeg output buffer + the coefficient
+    buffer of an optimized encode. Tiles are encoded one at a time, so a
+    tiled product only holds one tile.
+    """
+    h, w = shape[0], shape[1]
+    if tile:
+        h, w = min(tile, h), min(tile, w)
+    cost = w * h * 4
+    if opts.get('optimize'):
+        # PIL allocates a whole-image output buffer, libjpeg keeps every DCT
+        # coefficient (2 bytes) for the Huffman pass: 3/2/1.5 per pixel at 4:4:4/4:2:2/4:2:0
+        cost += w * h * (2 if opts.get('quality', 75) >= 95 else 1)
+        cost += w * h * {0: 6, 1: 4}.get(opts.get('subsampling', 2), 3)
+    else:
+        cost += 65536
+    if budget:
+        cost += w * h  # in-memory trial encodes + reduced proxy
+    return cost
+
+def write_tiles(frame, base_path, tile, opts):
+    """
+    Write a uint8 (h, w, 3) frame as a grid of independently decodable JPEG
+    tiles <base>_rXXcYY.jpg plus <base>_index.json, returns the paths
+    (index last). The ground can fetch only the tiles it needs.
+    """
+    from PIL import Image
+
+    h, w, _ = frame.shape
+    rows, cols = -(-h // tile), -(-w // tile)
+    index = {'width': w, 'height': h, 'tile': tile, 'rows': rows, 'cols': cols,
+             'quality': opts.get('quality'), 'tiles': []}
+    paths = []
+    for r in range(rows):
+        for c in range(cols):
+            y, x = r * tile, c * tile
+            th, tw = min(tile, h - y), min(tile, w - x)
+            path = f"{base_path}_r{r:02d}c{c:02d}.jpg"
+            Image.fromarray(frame[y:y + th, x:x + tw], mode='RGB').save(path, format='JPEG', **opts)
+            paths.append(path)
+            index['tiles'].append({'file': os.path.basename(path), 'row': r, 'col': c,
+                                   'x': x, 'y': y, 'w': tw, 'h': th,
+                                   'bytes': os.path.getsize(path)})
+    index_path = base_path + "_index.json"
+    with open(index_path, 'w') as f:
+        json.dump(index, f)
+    paths.append(index_path)
+    return paths
+
+def write_quicklook(raw_img, base_out, camera, log=print):
+    """Write <base>_quicklook.jpg/.json from raw_img.quicklook(), returns the paths."""
+    from PIL import Image
+
+    t0 = time.perf_counter()
+    rgb8, stats = raw_img.quicklook()
+    jpg_path = base_out + "_quicklook.jpg"
+    Image.fromarray(rgb8, mode='RGB').save(jpg_path, format='JPEG', **QUICKLOOK_OPTS)
+    stats.update({'width': raw_img.width, 'height': raw_img.height, 'camera': camera,
+                  'source': os.path.basename(raw_img.path)})
+    json_path = base_out + "_quicklook.json"
+    with open(json_path, 'w') as f:
+        json.dump(stats, f)
+    sat = ", ".join(f"{c}={stats[c]['saturated']}" for c in 'rgb')
+    log(f"[v] Saved quicklook {rgb8.shape[1]}x{rgb8.shape[0]} in {time.perf_counter() - t0:.3f}s "
+        f"(saturated {sat}): {jpg_path}")
+    return [jpg_path, json_path]
+
+def tile_arg(text):
+    """Tile size option value: 0 (off) or a positive multiple of 16 (JPEG MCU)."""
+    tile = int(text)
+    if tile < 0 or tile % 16:
+        raise argparse.ArgumentTypeError("tile size must be 0 or a multiple of 16")
+    return tile
+
+def budget_arg(text):
+    """PRODUCT=BYTES option value -> (product, bytes)."""
+    name, _, size = text.partition('=')
+    if name not in PRODUCTS or not size.isdigit():
+        raise argparse.ArgumentTypeError(f"expected PRODUCT=BYTES with PRODUCT in {sorted(PRODUCTS)}")
+    return name, int(size)
+
+def camera_id(args):
+    """Camera id of the request: --camera, else CAMx from the input file name."""
+    if args.camera is not None:
+        return args.camera
+    m = re.search(r'(CAM\d+)', os.path.basename(args.infile))
+    return m.group(1) if m else None
+
+def encode_workers(costs, workers, budget=ENCODE_MEM_BUDGET):
+    """Largest worker count <= workers whose costliest concurrent encodes fit the budget."""
+    costs = sorted(costs, reverse=True)
+    n = max(1, min(workers, len(costs)))
+    while n > 1 and sum(costs[:n]) > budget:
+        n -= 1
+    return n
+
+def build_parser():
     parser = argparse.ArgumentParser(description='Convert raw10p image to dual JPEGs (IMX93 minimal).')
     parser.add_argument('-H', dest='height', type=int, required=True)
     parser.add_argument('-W', dest='width', type=int, required=True)
@@ -24,58 +158,270 @@ def main():
     parser.add_argument('-b', dest='bayer', choices=['rggb', 'bggr', 'grbg', 'gbrg'], default='grbg')
     parser.add_argument('-c', dest='crop', action='store_true',
                         help='Enable cropping for low-quality image')
-    parser.add_argument('infile', metavar='InputRawFile', help='Input raw10p file')
-    args = parser.parse_args()
+    parser.add_argument('-L', dest='low_only', action='store_true',
+                        help='Only write the low image; with -c only the crop window is read from the raw')
+    parser.add_argument('-p', dest='policy', choices=['float64', 'float32', 'uint16'], default='float32',
+                        help='Unpack dtype policy (float64 = legacy path)')
+    parser.add_argument('-S', dest='strip_rows', type=int, default=256,
+                        help='Streaming decode strip height in rows, 0 = full-frame decode')
+    parser.add_argument('-j', dest='workers', type=int, default=os.cpu_count() or 1,
+                        help='Decode worker threads for the streaming decode (default: CPU count)')
+    parser.add_argument('-D', dest='engine', choices=DEMOSAIC_CHOICES, default='bilinear',
+                        help='Demosaic engine (half = 2x2 binning to half resolution)')
+    parser.add_argument('--awb', dest='awb', choices=AWB_CHOICES, default='fixed',
+                        help='White balance: fixed gains or per-frame estimate (cached per camera)')
+    parser.add_argument('--camera', dest='camera', default=None,
+                        help='Camera id for the AWB/quality caches (default: CAMx from the file name)')
+    parser.add_argument('-g', dest='gamma', type=float, default=1.0,
+                        help='Gamma of the colour stage (1.0 = linear)')
+    parser.add_argument('--ccm', dest='ccm', action='store_true',
+                        help='Apply the default colour correction matrix')
+    parser.add_argument('-e', dest='encode_workers', type=int, default=os.cpu_count() or 1,
+                        help='Concurrent JPEG encodes of the products (default: CPU count, '
+                             'reduced to fit ENCODE_MEM_BUDGET)')
+    parser.add_argument('-B', dest='budgets', type=budget_arg, action='append', default=[],
+                        metavar='PRODUCT=BYTES',
+                        help='Byte budget of a product (e.g. low=40000): the JPEG quality is '
+                             'searched, starting from the last quality of this camera')
+    parser.add_argument('-t', dest='tile', type=tile_arg, default=0,
+                        help='Write the high product as independently decodable JPEG tiles of this '
+                             'size plus <out>_high_index.json (0 = one JPEG)')
+    parser.add_argument('-T', dest='thumb', action='store_true',
+                        help='Also write a 1/16 thumbnail (<out>_thumb.jpg)')
+    parser.add_argument('-Q', dest='quicklook', action='store_true',
+                        help='Only write the quicklook: a 1/16 thumbnail (<out>_quicklook.jpg) and '
+                             'per-channel histograms/saturation counts (<out>_quicklook.json) '
+                             'from a strided subsample of the raw, no full decode')
+    parser.add_argument('-M', dest='metrics', metavar='FILE', default=None,
+                        help='Profile the conversion stages (wall/CPU time, peak RSS growth) and '
+                             'append one JSON line per frame to FILE')
+    parser.add_argument('--local', dest='local', action='store_true',
+                        help='Convert in this process instead of handing off to raw_service.py')
+    parser.add_argument('infile', metavar='InputRawFile', help='Input raw10p file, or a .rawz archive (geometry and Bayer from its header)')
+    return parser
+
+def args_from_request(req):
+    """argparse namespace for a service request ({"infile", "width", "height", "outfile", ...})."""
+    args = build_parser().parse_args(['-H', str(req['height']), '-W', str(req['width']),
+                                      '-o', req['outfile'], req['infile']])
+    for key, value in req.items():
+        if not hasattr(args, key):
+            raise ValueError("unknown request field: %s" % key)
+        setattr(args, key, value)
+    return args
+
+def append_metrics(path, record):
+    """Append one JSON line to the metrics log `path`."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + "\n")
+
+def convert(args, frames=None, log=print, buffer=None):
+    """
+    Decode args.infile once and write the requested PRODUCTS from its
+    pyramid, returns the output paths.
+    frames is an optional {shape: uint8 frame} pool reused across calls (the
+    service keeps one), log receives the progress lines.
+    buffer is an in-memory raw10p frame (e.g. a dequeued V4L2 buffer) decoded
+    instead of the file, args.infile then only names it (camera id, metrics).
+    With args.metrics the stages are profiled and one JSON record per frame
+    is appended to that file.
+    """
+    from raw_decoder import StageProfiler
+
+    profiler = StageProfiler() if args.metrics else None
+    outputs = _convert(args, frames, log, profiler, buffer)
+    if profiler is not None:
+        append_metrics(args.metrics, profiler.record(
+            time=int(time.time()), infile=os.path.basename(args.infile), camera=camera_id(args),
+            width=args.width, height=args.height, engine=args.engine, policy=args.policy,
+            outputs=[os.path.basename(p) for p in outputs]))
+        log(f"[v] Metrics appended to {args.metrics}")
+    return outputs
+
+def _convert(args, frames, log, profiler, buffer=None):
+    import numpy as np
+    from PIL import Image
+    from raw_decoder import (Raw10PaddedImage, RawzImage, DEMOSAIC_ENGINES, AwbGainCache, ColorPipeline,
+                             DEFAULT_CCM, build_pyramid, profile_stage)
+    from jpeg_budget import fit_budget, QualityCache
 
     base_out = os.path.splitext(args.outfile)[0]
-    out_low = base_out + "_low.jpg"
-    out_high = base_out + "_high.jpg"
+    outputs = []
+    budgets = dict(args.budgets)
+    if args.tile and 'high' in budgets:
+        raise ValueError("a byte budget for the high product cannot be combined with tiling")
 
     # Load RAW10 padded (10-bit in 16-bit)
-    raw_img = Raw10PaddedImage(args.infile, args.width, args.height, args.offset, args.bayer)
-    raw_img.load()
-    rgb = raw_img.getRGB()
-    if rgb.dtype != np.float32:
-        rgb = rgb.astype(np.float32, copy=False)
-
-    # Clip and convert to 8-bit
-    np.clip(rgb, 0.0, 1.0, out=rgb)
-    rgb8 = (rgb * 255).astype(np.uint8)
-    del rgb
+    if args.infile.endswith('.rawz') and buffer is None:
+        raw_img = RawzImage(args.infile, args.width, args.height)
+    else:
+        raw_img = Raw10PaddedImage(args.infile, args.width, args.height, args.offset, args.bayer)
+        raw_img.buffer = buffer
+    raw_img.profiler = profiler
+    camera = camera_id(args)
+    if args.awb != 'fixed':
+        raw_img.awb = args.awb
+        raw_img.camera = camera
+        raw_img.awbCache = AwbGainCache()
+    raw_img.color = ColorPipeline(raw_img.dgain, DEFAULT_CCM if args.ccm else None, args.gamma)
+    if args.quicklook:
+        return write_quicklook(raw_img, base_out, camera, log)
+    low_roi = args.low_only and args.crop
+    d = DEMOSAIC_ENGINES[args.engine][1]  # decoded frame = raw size / d
+    if low_roi:
+        # Decode only the crop window straight from the memory-mapped raw
+        left, top, right, bottom = crop_box(args.width, args.height)
+        _, rgb8 = raw_img.loadRoi(top, bottom, left, right, args.policy, args.engine)
+    else:
+        # Streaming decode: the colour stage writes each strip straight into
+        # the 8-bit frame (-S 0 = one strip of the full frame)
+        strip_rows = args.strip_rows if args.strip_rows > 0 else args.height
+        frame = None
+        if frames is not None:
+            shape = (args.height // d, args.width // d, 3)
+            frame = frames.get(shape)
+            if frame is None:
+                frame = frames[shape] = np.empty(shape, dtype=np.uint8)
+        rgb8 = raw_img.loadStrips(strip_rows=strip_rows, dtype=args.policy,
+                                  engine=args.engine, workers=args.workers, out=frame)
+    del raw_img
     gc.collect()
 
     h, w, _ = rgb8.shape
-    img = Image.fromarray(rgb8, mode='RGB')
+    if low_roi:
+        log(f"[v] Decoded crop window only: {w}x{h}")  # đã decode đúng vùng crop
+
+    # --- One decode, every product from the 2x2 binned pyramid ---
+    products = [] if args.low_only else ['high']
+    products.append('low')
+    if args.thumb:
+        products.append('thumb')
+    levels = {name: max(PRODUCTS[name][0], d) for name in products}
+    with profile_stage(profiler, 'pyramid'):
+        pyramid = build_pyramid(rgb8, sorted(set(levels.values())), base=d)
     del rgb8
-    gc.collect()
 
-    # --- Save high-quality full image ---
-    img.save(out_high,
-             format='JPEG',
-             quality=90,
-             subsampling=0,
-             optimize=False)
-    print(f"[v] Saved high quality: {out_high}")
-
-    # --- Create low-quality version ---
-    if args.crop:
-        left = int(w * CROP_LEFT)
-        right = int(w * (1.0 - CROP_RIGHT))
-        top = int(h * CROP_TOP)
-        bottom = int(h * (1.0 - CROP_BOTTOM))
-        img_low = img.crop((left, top, right, bottom))
-        print(f"[v] Cropped low image: top={CROP_TOP}, bottom={CROP_BOTTOM}, left={CROP_LEFT}, right={CROP_RIGHT}")
-    else:
-        img_low = img.copy()  # không crop
+    quality_cache = QualityCache() if budgets else None
+
+    def encode(name):
+        with profile_stage(profiler, 'encode_' + name):
+            return encode_product(name)
 
-    img_low = img_low.resize((img_low.width // 4, img_low.height // 4))
-    img_low.save(out_low, format='JPEG', quality=60, subsampling=2, optimize=True)
-    print(f"[v] Saved low quality: {out_low}")
+    def encode_product(name):
+        level, opts = levels[name], PRODUCTS[name][1]
+        lines = []
+        path = f"{base_out}_{name}.jpg"
+        if name == 'high' and args.tile:
+            paths = write_tiles(pyramid[level], f"{base_out}_{name}", args.tile, opts)
+            lines.append(f"[v] Saved {name} quality as {len(paths) - 1} tiles of {args.tile}px: {paths[-1]}")
+            return paths, lines
+        # Crop as a view before fromarray, PIL then copies only the window
+        arr = pyramid[level]
+        if name == 'low' and args.crop and not low_roi:
+            with profile_stage(profiler, 'crop'):
+                left, top, right, bottom = crop_box(arr.shape[1], arr.shape[0])
+                arr = arr[top:bottom, left:right]
+            lines.append(f"[v] Cropped low image: top={CROP_TOP}, bottom={CROP_BOTTOM}, left={CROP_LEFT}, right={CROP_RIGHT}")
+        img = Image.fromarray(arr, mode='RGB')
+        del arr
+        if name in budgets:
+            jpeg_opts = {k: v for k, v in opts.items() if k != 'quality'}
+            q, data, encodes = fit_budget(img, budgets[name], camera, name, quality_cache, **jpeg_opts)
+            with open(path, 'wb') as f:
+                f.write(data)
+            level_msg = "[v] Budget" if len(data) <= budgets[name] else "[WARN] Over budget"
+            lines.append(f"{level_msg} {name}: quality={q} size={len(data)}/{budgets[name]} B ({encodes} encodes)")
+        else:
+            img.save(path, format='JPEG', **opts)
+        lines.append(f"[v] Saved {name} quality: {path}" if name != 'thumb' else f"[v] Saved thumbnail: {path}")
+        return [path], lines
 
-    del img, img_low, raw_img
+    # PIL releases the GIL inside libjpeg, so the products encode concurrently
+    # from the shared pyramid; the worker count is capped by ENCODE_MEM_BUDGET
+    def encoded_shape(name):
+        h, w = pyramid[levels[name]].shape[:2]
+        if name == 'low' and args.crop and not low_roi:
+            left, top, right, bottom = crop_box(w, h)
+            return bottom - top, right - left
+        return h, w
+
+    costs = [encode_cost(encoded_shape(name), PRODUCTS[name][1], name in budgets,
+                         args.tile if name == 'high' else 0)
+             for name in products]
+    workers = encode_workers(costs, args.encode_workers)
+    if workers > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(encode, products))
+    else:
+        results = [encode(name) for name in products]
+    for paths, lines in results:
+        outputs.extend(paths)
+        for line in lines:
+            log(line)
+
+    pyramid = results = None  # the encode closures hold the cell, rebind to free
     gc.collect()
+    return outputs
+
+def request_service(args, path=SERVICE_SOCKET, timeout=SERVICE_TIMEOUT):
+    """
+    Hand the conversion to raw_service.py. Returns the reply dict, or None
+    when the service is not running so the caller can convert locally.
+    """
+    req = {k: v for k, v in vars(args).items() if k != 'local'}
+    req['infile'] = os.path.abspath(args.infile)
+    req['outfile'] = os.path.abspath(args.outfile)
+    if args.metrics:
+        req['metrics'] = os.path.abspath(args.metrics)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    try:
+        sock.settimeout(timeout)
+        sock.sendall((json.dumps(req) + "\n").encode())
+        buf = bytearray()
+        while not buf.endswith(b"\n"):
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            buf.extend(chunk)
+    finally:
+        sock.close()
+    if not buf:
+        return {'ok': False, 'error': 'service closed the connection', 'log': []}
+    return json.loads(buf.decode())
+
+def done_message(args):
+    if args.quicklook:
+        return "[v] Done: quicklook generated"
+    return "[v] Done: low generated" if args.low_only else "[v] Done: both low/high generated"
+
+def main():
+    args = build_parser().parse_args()
+
+    if not args.local:
+        t0 = time.perf_counter()
+        reply = request_service(args)
+        if reply is not None:
+            for line in reply.get('log', []):
+                print(line)
+            if not reply.get('ok'):
+                print(f"[ERROR] raw_service: {reply.get('error')}")
+                return 1
+            print(f"[v] Converted by raw_service in {reply['elapsed_s']:.3f}s "
+                  f"(round trip {time.perf_counter() - t0:.3f}s)")
+            print(done_message(args))
+            return 0
+
+    convert(args)
     time.sleep(0.3)
-    print("[v] Done: both low/high generated")
+    print(done_message(args))
+    return 0
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
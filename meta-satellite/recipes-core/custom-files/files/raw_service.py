@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Raw Conversion Service - resident raw10p -> JPEG converter
+Keeps the interpreter, NumPy/PIL and the decode frame buffers warm so each
+request only pays for the decode itself. raw_imx93.py (and file_watcher)
+send one JSON request per connection on a Unix stream socket.
+"""
+import sys
+import os
+import time
+import json
+import socket
+import traceback
+import importlib
+
+import raw_imx93
+
+# Heavy imports once at start-up, this is what every CLI invocation used to pay
+PRELOAD_MODULES = ('numpy', 'PIL.Image', 'raw_decoder', 'jpeg_budget')
+
+def preload():
+    """Import the conversion modules now so requests find them warm."""
+    for name in PRELOAD_MODULES:
+        importlib.import_module(name)
+
+preload()
+
+SOCKET_PATH = raw_imx93.SERVICE_SOCKET
+MAX_REQUEST = 64 * 1024
+
+class RawService:
+    """
+    Raw conversion daemon
+    - Unix stream socket, one JSON request -> one JSON reply per connection
+    - Requests are served one at a time (a full frame decode is the memory peak)
+    - Frame buffers are kept per output shape and reused between requests
+    """
+    def __init__(self, path=SOCKET_PATH):
+        self.path = path
+        self.frames = {}
+        self.served = 0
+
+    def handle(self, req):
+        """Run one conversion request, returns the reply dict."""
+        t0 = time.perf_counter()
+        lines = []
+        try:
+            args = raw_imx93.args_from_request(req)
+            outputs = raw_imx93.convert(args, frames=self.frames, log=lines.append)
+            reply = {'ok': True, 'outputs': outputs}
+        except Exception as e:
+            traceback.print_exc()
+            reply = {'ok': False, 'error': str(e)}
+        reply['log'] = lines
+        reply['elapsed_s'] = time.perf_counter() - t0
+        self.served += 1
+        return reply
+
+    def _serve_conn(self, conn):
+        conn.settimeout(10.0)
+        buf = bytearray()
+        while not buf.endswith(b"\n") and len(buf) < MAX_REQUEST:
+            chunk = conn.recv(4096)
+            if not chunk:
+                break
+            buf.extend(chunk)
+        if not buf.strip():
+            return
+        try:
+            req = json.loads(buf.decode())
+        except ValueError as e:
+            reply = {'ok': False, 'error': f"bad request: {e}", 'log': [], 'elapsed_s': 0.0}
+        else:
+            print(f"[SERVICE] Request: {req.get('infile')}")
+            reply = self.handle(req)
+            status = "ok" if reply['ok'] else f"failed: {reply['error']}"
+            print(f"[SERVICE] #{self.served} {status} in {reply['elapsed_s']:.3f}s")
+        conn.sendall((json.dumps(reply) + "\n").encode())
+
+    def run(self):
+        """Run daemon - blocking call"""
+        print("\n" + "="*60)
+        print("Raw Conversion Service Starting...")
+        print("="*60)
+
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+        # Owner-only: a request names arbitrary output paths written as root
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)
+        try:
+            sock.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        os.chmod(self.path, 0o600)
+        sock.listen(4)
+        print(f"[SERVICE] Listening on {self.path}")
+
+        try:
+            while True:
+                conn, _ = sock.accept()
+                try:
+                    self._serve_conn(conn)
+                except Exception as e:
+                    print(f"[ERROR] Service connection: {e}")
+                finally:
+                    conn.close()
+        except KeyboardInterrupt:
+            print("\n[SERVICE] Shutting down...")
+        finally:
+            sock.close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+        return 0
+
+# ------------- Main Entry Point -------------
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else SOCKET_PATH
+    return RawService(path).run()
+
+if __name__ == "__main__":
+    sys.exit(main())
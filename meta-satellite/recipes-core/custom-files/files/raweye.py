@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import os
 import sys
 import argparse
 import numpy as np
@@ -6,9 +7,7 @@ import numpy as np
 from imageio import imwrite
 from raw_decoder import *
 
-g_ccm = np.array([[1.2085, -0.2502, 0.0417],
-                  [-0.1174, 1.1625, -0.0452],
-                  [0.0226, -0.2524, 1.2298]])
+g_ccm = DEFAULT_CCM
 
 if "__main__" == __name__:
     parser = argparse.ArgumentParser(description='Show raw image or convert it to jpeg/png.',
@@ -16,9 +15,10 @@ if "__main__" == __name__:
     parser.add_argument('-H', dest='height', type=int, required=True)
     parser.add_argument('-W', dest='width', type=int)
     parser.add_argument('-s', dest='offset', type=int, default = 0)
-    parser.add_argument('-t', dest='rawtype', choices = ['raw10', 'raw16', 'raw8', 'raw', 'raw10p', 'gray', 'yuv', 'yvu'],
+    parser.add_argument('-t', dest='rawtype', choices = ['raw10', 'raw16', 'raw8', 'raw', 'mipi', 'raw10p', 'gray', 'yuv', 'yvu'],
                         help='raw10 : continue 10bits\n'
                              'raw   : mipi 10bits\n'
+                             'mipi  : mipi 10bits (Oneshot ONESHOT_PACK files)\n'
                              'raw10p : raw10 padded (10-bit in 16-bit, 2 bytes per pixel)\n'
                              'raw16 : 16bits\n'
                              'raw8  : 8bits\n'
@@ -27,6 +27,11 @@ if "__main__" == __name__:
                              'yvu   : yvu420 8bits')
     parser.add_argument('-b', dest='bayer', choices=['rggb', 'bggr', 'grbg', 'gbrg'], default='rggb')
     parser.add_argument('-d', dest='dgain', type=float, default=1.0, help='digit gain apply')
+    parser.add_argument('-g', dest='gamma', type=float, default=1.0, help='gamma apply (bayer types)')
+    parser.add_argument('-S', dest='strip_rows', type=int, default=0,
+                        help='streaming decode strip height for bayer types (0 = one full-frame strip)')
+    parser.add_argument('-D', dest='engine', choices=sorted(DEMOSAIC_ENGINES), default='bilinear',
+                        help='demosaic engine for bayer types')
     parser.add_argument('-o', dest='outfile', metavar='FILE', help='write image to FILE')
     parser.add_argument('infile', metavar='InputRawFile', help='source raw image')
     args = parser.parse_args()
@@ -38,6 +43,7 @@ if "__main__" == __name__:
 
     rawmap = {'raw10': Raw10Image(args.infile, args.width, args.height, args.offset, args.bayer),
               'raw'  : MipiRawImage(args.infile, args.width, args.height, args.offset, args.bayer),
+              'mipi' : MipiRawImage(args.infile, args.width, args.height, args.offset, args.bayer),
               'raw10p': Raw10PaddedImage(args.infile, args.width, args.height, args.offset, args.bayer),
               'raw8': Raw8Image(args.infile, args.width, args.height, args.offset, args.bayer),
               'raw16': Raw16Image(args.infile, args.width, args.height, args.offset, args.bayer),
@@ -50,10 +56,20 @@ if "__main__" == __name__:
         sys.exit(0)
 
     rawImage = rawmap[args.rawtype]
-    rawImage.load()
-    rgb = rawImage.getRGB()
-    np.clip(rgb, 0.0, 1.0, out=rgb)
-    rgb = (rgb * 255).astype(np.uint8)
+    if isinstance(rawImage, RawBayerImage):
+        # gain, ccm, gamma and 8-bit quantise in one colour stage
+        rawImage.color = ColorPipeline(rawImage.dgain * args.dgain, g_ccm, args.gamma)
+        if rawImage.width is None:
+            # no -W: width from the file size (load() used to reshape(h, -1))
+            row_bytes = (os.path.getsize(args.infile) - args.offset) // args.height
+            rawImage.width = int(row_bytes / rawImage.usize)
+        strip_rows = args.strip_rows if args.strip_rows > 0 else args.height
+        rgb = rawImage.loadStrips(strip_rows=strip_rows, engine=args.engine)
+    else:
+        rawImage.load()
+        rgb = rawImage.getRGB()
+        np.clip(rgb, 0.0, 1.0, out=rgb)
+        rgb = (rgb * 255).astype(np.uint8)
 
     if args.outfile:
         imwrite(args.outfile, rgb)
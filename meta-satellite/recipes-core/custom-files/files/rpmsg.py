@@ -242,6 +242,41 @@ class RPMSGTester:
             print(f"[x] capture exception: {e}")
             # self._send_response(f"-capture error {str(e)}")
 
+    def _handle_capture_all(self, args):
+        """
+        Xử lý command capture_all <id,id,...>
+        Ví dụ:
+          capture_all 0,1,2,3  → chạy python3 /home/root/tools/capture.py all 0,1,2,3 --daily
+        /dev/video0 chỉ mở + set format một lần cho cả lượt chụp.
+        """
+        try:
+            if not args:
+                # self._send_response("-capture_all error: missing camera list")
+                return
+
+            ids = [c for c in args[0].split(",") if c]
+            if not ids or not all(c.isdigit() and int(c) < 4 for c in ids):
+                # self._send_response(f"-capture_all error: invalid list {args[0]}")
+                return
+
+            cmd = ["python3", "/home/root/tools/capture.py", "all", ",".join(ids), "--daily"]
+            print(f"[v] Executing capture sweep: {' '.join(cmd)}")
+
+            output = subprocess.check_output(cmd, stderr=subprocess.STDOUT,
+                                             timeout=30 + 30 * len(ids)).decode("utf-8", errors="ignore")
+            print(f"[v] capture.py output:\n{output}")
+            # self._send_response(f"-capture_all done {','.join(ids)}")
+        except subprocess.CalledProcessError as e:
+            err_msg = e.output.decode("utf-8", errors="ignore")
+            print(f"[x] capture.py sweep failed: {err_msg}")
+            # self._send_response(f"-capture_all failed {e.returncode}")
+        except subprocess.TimeoutExpired:
+            print("[x] capture.py sweep timeout")
+            # self._send_response("-capture_all timeout")
+        except Exception as e:
+            print(f"[x] capture_all exception: {e}")
+            # self._send_response(f"-capture_all error {str(e)}")
+
     # ------------- RX (Reader) -------------
     def start_receiver(self):
         if self.rx_thread and self.rx_thread.is_alive():
@@ -356,6 +391,9 @@ class RPMSGTester:
             elif name == "capture":
                 self._handle_capture(parts[1:] if len(parts) > 1 else [])
                 return
+            elif name == "capture_all":
+                self._handle_capture_all(parts[1:] if len(parts) > 1 else [])
+                return
         # Otherwise, just log
         # (You may route other message types here if firmware defines them)
         # print(f"[RX-INFO] {text}")
@@ -45,6 +45,17 @@ EOF
 
 # ---- step2_file_watcher.conf ----
 cat > "$CONF_DIR/step2_file_watcher.conf" <<'EOF'
+[program:raw_service]
+command=python3 /home/root/tools/raw_service.py
+autostart=true
+autorestart=true
+startsecs=3
+priority=19
+stdout_logfile=/data/Oneshot/raw_service.log
+stderr_logfile=/data/Oneshot/raw_service.err
+stdout_logfile_maxbytes=256KB
+stderr_logfile_maxbytes=256KB
+
 [program:file_watcher]
 command=python3 /home/root/tools/file_watcher.py
 autostart=true
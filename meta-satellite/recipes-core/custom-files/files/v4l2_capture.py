@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+"""
+V4L2 Capture - minimal V4L2 streaming backend (ioctl + mmap), no v4l2-ctl
+- The device is opened once, the format is set with VIDIOC_S_FMT
+- MMAP buffers are requested, mapped and queued once, then streamed
+- Dequeued frames are views of the mapped buffers: written to disk with
+  os.write() straight from the mapping, no intermediate copy
+- Frames carry the driver sequence number and the monotonic timestamp
+Works with single-planar and multi-planar (i.MX93 ISI) capture nodes,
+only the first plane is used.
+"""
+import os
+import sys
+import mmap
+import time
+import fcntl
+import select
+import ctypes
+import argparse
+
+# ===== ioctl encoding (asm-generic/ioctl.h) =====
+_IOC_WRITE = 1
+_IOC_READ = 2
+
+def _IOC(direction, nr, struct):
+    return (direction << 30) | (ctypes.sizeof(struct) << 16) | (ord('V') << 8) | nr
+
+def _IOR(nr, struct):
+    return _IOC(_IOC_READ, nr, struct)
+
+def _IOW(nr, struct):
+    return _IOC(_IOC_WRITE, nr, struct)
+
+def _IOWR(nr, struct):
+    return _IOC(_IOC_READ | _IOC_WRITE, nr, struct)
+
+def fourcc(code):
+    """'BA10' -> V4L2 pixel format code."""
+    a, b, c, d = code.encode('ascii')
+    return a | (b << 8) | (c << 16) | (d << 24)
+
+def fourcc_str(value):
+    return bytes((value >> s) & 0xFF for s in (0, 8, 16, 24)).decode('ascii', 'replace')
+
+V4L2_BUF_TYPE_VIDEO_CAPTURE = 1
+V4L2_BUF_TYPE_VIDEO_CAPTURE_MPLANE = 9
+V4L2_MEMORY_MMAP = 1
+V4L2_FIELD_NONE = 1
+V4L2_CAP_VIDEO_CAPTURE = 0x00000001
+V4L2_CAP_VIDEO_CAPTURE_MPLANE = 0x00001000
+V4L2_CAP_STREAMING = 0x04000000
+V4L2_CAP_DEVICE_CAPS = 0x80000000
+V4L2_BUF_FLAG_ERROR = 0x00000040
+V4L2_BUF_FLAG_TIMESTAMP_MASK = 0x0000e000
+V4L2_BUF_FLAG_TIMESTAMP_MONOTONIC = 0x00002000
+VIDEO_MAX_PLANES = 8
+
+# ===== videodev2.h structures =====
+class v4l2_capability(ctypes.Structure):
+    _fields_ = [('driver', ctypes.c_char * 16), ('card', ctypes.c_char * 32),
+                ('bus_info', ctypes.c_char * 32), ('version', ctypes.c_uint32),
+                ('capabilities', ctypes.c_uint32), ('device_caps', ctypes.c_uint32),
+                ('reserved', ctypes.c_uint32 * 3)]
+
+class v4l2_pix_format(ctypes.Structure):
+    _fields_ = [('width', ctypes.c_uint32), ('height', ctypes.c_uint32),
+                ('pixelformat', ctypes.c_uint32), ('field', ctypes.c_uint32),
+                ('bytesperline', ctypes.c_uint32), ('sizeimage', ctypes.c_uint32),
+                ('colorspace', ctypes.c_uint32), ('priv', ctypes.c_uint32),
+                ('flags', ctypes.c_uint32), ('ycbcr_enc', ctypes.c_uint32),
+                ('quantization', ctypes.c_uint32), ('xfer_func', ctypes.c_uint32)]
+
+class v4l2_plane_pix_format(ctypes.Structure):
+    _pack_ = 1
+    _fields_ = [('sizeimage', ctypes.c_uint32), ('bytesperline', ctypes.c_uint32),
+                ('reserved', ctypes.c_uint16 * 6)]
+
+class v4l2_pix_format_mplane(ctypes.Structure):
+    _pack_ = 1
+    _fields_ = [('width', ctypes.c_uint32), ('height', ctypes.c_uint32),
+                ('pixelformat', ctypes.c_uint32), ('field', ctypes.c_uint32),
+                ('colorspace', ctypes.c_uint32),
+                ('plane_fmt', v4l2_plane_pix_format * VIDEO_MAX_PLANES),
+                ('num_planes', ctypes.c_uint8), ('flags', ctypes.c_uint8),
+                ('ycbcr_enc', ctypes.c_uint8), ('quantization', ctypes.c_uint8),
+                ('xfer_func', ctypes.c_uint8), ('reserved', ctypes.c_uint8 * 7)]
+
+class _v4l2_format_fmt(ctypes.Union):
+    # raw_data is 200 bytes; the pointer member gives the union its 64-bit alignment
+    _fields_ = [('pix', v4l2_pix_format), ('pix_mp', v4l2_pix_format_mplane),
+                ('raw_data', ctypes.c_uint8 * 200), ('_align', ctypes.c_void_p)]
+
+class v4l2_format(ctypes.Structure):
+    _fields_ = [('type', ctypes.c_uint32), ('fmt', _v4l2_format_fmt)]
+
+class v4l2_requestbuffers(ctypes.Structure):
+    _fields_ = [('count', ctypes.c_uint32), ('type', ctypes.c_uint32),
+                ('memory', ctypes.c_uint32), ('capabilities', ctypes.c_uint32),
+                ('flags', ctypes.c_uint8), ('reserved', ctypes.c_uint8 * 3)]
+
+class timeval(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_usec', ctypes.c_long)]
+
+class v4l2_timecode(ctypes.Structure):
+    _fields_ = [('type', ctypes.c_uint32), ('flags', ctypes.c_uint32),
+                ('frames', ctypes.c_uint8), ('seconds', ctypes.c_uint8),
+                ('minutes', ctypes.c_uint8), ('hours', ctypes.c_uint8),
+                ('userbits', ctypes.c_uint8 * 4)]
+
+class _v4l2_plane_m(ctypes.Union):
+    _fields_ = [('mem_offset', ctypes.c_uint32), ('userptr', ctypes.c_ulong),
+                ('fd', ctypes.c_int32)]
+
+class v4l2_plane(ctypes.Structure):
+    _fields_ = [('bytesused', ctypes.c_uint32), ('length', ctypes.c_uint32),
+                ('m', _v4l2_plane_m), ('data_offset', ctypes.c_uint32),
+                ('reserved', ctypes.c_uint32 * 11)]
+
+class _v4l2_buffer_m(ctypes.Union):
+    _fields_ = [('offset', ctypes.c_uint32), ('userptr', ctypes.c_ulong),
+                ('planes', ctypes.POINTER(v4l2_plane)), ('fd', ctypes.c_int32)]
+
+class v4l2_buffer(ctypes.Structure):
+    _fields_ = [('index', ctypes.c_uint32), ('type', ctypes.c_uint32),
+                ('bytesused', ctypes.c_uint32), ('flags', ctypes.c_uint32),
+                ('field', ctypes.c_uint32), ('timestamp', timeval),
+                ('timecode', v4l2_timecode), ('sequence', ctypes.c_uint32),
+                ('memory', ctypes.c_uint32), ('m', _v4l2_buffer_m),
+                ('length', ctypes.c_uint32), ('reserved2', ctypes.c_uint32),
+                ('request_fd', ctypes.c_int32)]
+
+VIDIOC_QUERYCAP = _IOR(0, v4l2_capability)
+VIDIOC_S_FMT = _IOWR(5, v4l2_format)
+VIDIOC_REQBUFS = _IOWR(8, v4l2_requestbuffers)
+VIDIOC_QUERYBUF = _IOWR(9, v4l2_buffer)
+VIDIOC_QBUF = _IOWR(15, v4l2_buffer)
+VIDIOC_DQBUF = _IOWR(17, v4l2_buffer)
+VIDIOC_STREAMON = _IOW(18, ctypes.c_int)
+VIDIOC_STREAMOFF = _IOW(19, ctypes.c_int)
+
+# ===== Defaults (AR2020 on /dev/video0) =====
+DEFAULT_DEVICE = "/dev/video0"
+DEFAULT_WIDTH = 5120
+DEFAULT_HEIGHT = 3840
+DEFAULT_FORMAT = "BA10"
+DEFAULT_BUFFERS = 2
+FRAME_TIMEOUT = 5.0
+
+# Significant bits of the 16-bit raw10p (BA10) samples
+RAW10P_MASK = 0x3FF
+
+class V4l2Error(OSError):
+    pass
+
+class FrameTimeout(V4l2Error):
+    """No buffer was filled within the timeout (the stream itself is fine)."""
+
+def write_buffer(path, data):
+    """Write a buffer (memoryview of a mapping) to `path` without copying it, returns the size."""
+    out = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        written = 0
+        while written < len(data):
+            written += os.write(out, data[written:])
+    finally:
+        os.close(out)
+    return written
+
+class Frame(object):
+    """A dequeued buffer: `data` is a memoryview of the mapping, valid until requeued."""
+    __slots__ = ('index', 'data', 'sequence', 'timestamp', 'flags')
+
+    def __init__(self, index, data, sequence, timestamp, flags):
+        self.index = index
+        self.data = data
+        self.sequence = sequence
+        self.timestamp = timestamp  # CLOCK_MONOTONIC seconds of the frame
+        self.flags = flags
+
+class V4l2Capture(object):
+    """
+    V4L2 MMAP streaming capture
+    Usage:
+        with V4l2Capture("/dev/video0") as cam:
+            cam.set_format(5120, 3840, "BA10")
+            cam.start()
+            info = cam.capture_to_file(path)
+    """
+    def __init__(self, device=DEFAULT_DEVICE):
+        self.device = device
+        self.fd = os.open(device, os.O_RDWR | os.O_NONBLOCK)
+        self.buffers = []        # mmap objects, one per V4L2 buffer
+        self.streaming = False
+        self.width = self.height = self.pixelformat = None
+        self.bytesperline = self.sizeimage = None
+        cap = v4l2_capability()
+        try:
+            self._ioctl(VIDIOC_QUERYCAP, cap)
+        except OSError:
+            os.close(self.fd)
+            raise
+        caps = cap.device_caps if cap.capabilities & V4L2_CAP_DEVICE_CAPS else cap.capabilities
+        if caps & V4L2_CAP_VIDEO_CAPTURE_MPLANE:
+            self.buf_type = V4L2_BUF_TYPE_VIDEO_CAPTURE_MPLANE
+        elif caps & V4L2_CAP_VIDEO_CAPTURE:
+            self.buf_type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+        else:
+            self.buf_type = None
+        if self.buf_type is None or not caps & V4L2_CAP_STREAMING:
+            os.close(self.fd)
+            raise V4l2Error("%s is not a streaming video capture device" % device)
+        self.mplane = self.buf_type == V4L2_BUF_TYPE_VIDEO_CAPTURE_MPLANE
+        self.driver = cap.driver.decode(errors='ignore')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _ioctl(self, request, arg):
+        try:
+            fcntl.ioctl(self.fd, request, arg)
+        except OSError as e:
+            raise V4l2Error(e.errno, "%s: ioctl 0x%08x: %s" % (self.device, request, e.strerror))
+
+    def set_format(self, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT, pixfmt=DEFAULT_FORMAT):
+        """VIDIOC_S_FMT, returns the (width, height, bytesperline, sizeimage) set by the driver."""
+        if self.streaming:
+            raise V4l2Error("cannot change the format while streaming")
+        fmt = v4l2_format()
+        fmt.type = self.buf_type
+        if self.mplane:
+            pix = fmt.fmt.pix_mp
+            pix.num_planes = 1
+        else:
+            pix = fmt.fmt.pix
+        pix.width, pix.height = width, height
+        pix.pixelformat = fourcc(pixfmt)
+        pix.field = V4L2_FIELD_NONE
+        self._ioctl(VIDIOC_S_FMT, fmt)
+        if pix.pixelformat != fourcc(pixfmt):
+            raise V4l2Error("%s: format %s not supported (driver chose %s)"
+                            % (self.device, pixfmt, fourcc_str(pix.pixelformat)))
+        self.width, self.height, self.pixelformat = pix.width, pix.height, pix.pixelformat
+        if self.mplane:
+            plane = pix.plane_fmt[0]
+            self.bytesperline, self.sizeimage = plane.bytesperline, plane.sizeimage
+        else:
+            self.bytesperline, self.sizeimage = pix.bytesperline, pix.sizeimage
+        return self.width, self.height, self.bytesperline, self.sizeimage
+
+    def _buffer(self, index=0):
+        buf = v4l2_buffer()
+        buf.type = self.buf_type
+        buf.memory = V4L2_MEMORY_MMAP
+        buf.index = index
+        planes = None
+        if self.mplane:
+            planes = (v4l2_plane * VIDEO_MAX_PLANES)()
+            buf.m.planes = ctypes.cast(planes, ctypes.POINTER(v4l2_plane))
+            buf.length = VIDEO_MAX_PLANES
+        return buf, planes
+
+    def start(self, count=DEFAULT_BUFFERS):
+        """Request, map and queue `count` MMAP buffers, then VIDIOC_STREAMON."""
+        if self.streaming:
+            return
+        req = v4l2_requestbuffers()
+        req.count, req.type, req.memory = count, self.buf_type, V4L2_MEMORY_MMAP
+        self._ioctl(VIDIOC_REQBUFS, req)
+        if req.count < 1:
+            raise V4l2Error("%s: no MMAP buffers granted" % self.device)
+        for i in range(req.count):
+            buf, planes = self._buffer(i)
+            self._ioctl(VIDIOC_QUERYBUF, buf)
+            if self.mplane:
+                length, offset = planes[0].length, planes[0].m.mem_offset
+            else:
+                length, offset = buf.length, buf.m.offset
+            self.buffers.append(mmap.mmap(self.fd, length, mmap.MAP_SHARED,
+                                          mmap.PROT_READ | mmap.PROT_WRITE, offset=offset))
+            self._ioctl(VIDIOC_QBUF, buf)
+        self._ioctl(VIDIOC_STREAMON, ctypes.c_int(self.buf_type))
+        self.streaming = True
+
+    def stop(self):
+        """VIDIOC_STREAMOFF and release the buffers (the format is kept)."""
+        if self.streaming:
+            self._ioctl(VIDIOC_STREAMOFF, ctypes.c_int(self.buf_type))
+            self.streaming = False
+        for m in self.buffers:
+            m.close()
+        if self.buffers:
+            self.buffers = []
+            req = v4l2_requestbuffers()
+            req.count, req.type, req.memory = 0, self.buf_type, V4L2_MEMORY_MMAP
+            self._ioctl(VIDIOC_REQBUFS, req)
+
+    def dequeue(self, timeout=FRAME_TIMEOUT):
+        """Wait for the next filled buffer, returns a Frame (give it back with requeue())."""
+        deadline = time.monotonic() + timeout
+        buf, planes = self._buffer()
+        while True:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise FrameTimeout("%s: no frame within %.1fs" % (self.device, timeout))
+            r, _, _ = select.select([self.fd], [], [], left)
+            if not r:
+                continue
+            try:
+                fcntl.ioctl(self.fd, VIDIOC_DQBUF, buf)
+                break
+            except BlockingIOError:
+                continue
+            except OSError as e:
+                raise V4l2Error(e.errno, "%s: VIDIOC_DQBUF: %s" % (self.device, e.strerror))
+        if self.mplane:
+            used, start = planes[0].bytesused, planes[0].data_offset
+        else:
+            used, start = buf.bytesused, 0
+        view = memoryview(self.buffers[buf.index])[start:used]
+        ts = buf.timestamp.tv_sec + buf.timestamp.tv_usec * 1e-6
+        return Frame(buf.index, view, buf.sequence, ts, buf.flags)
+
+    def requeue(self, frame):
+        """Hand the buffer of `frame` back to the driver, its data view is released."""
+        frame.data.release()
+        buf, _ = self._buffer(frame.index)
+        self._ioctl(VIDIOC_QBUF, buf)
+
+    def next_frame(self, timeout=FRAME_TIMEOUT, skip=0):
+        """dequeue() after dropping `skip` frames; frames flagged as errors are dropped too."""
+        while True:
+            frame = self.dequeue(timeout)
+            if frame.flags & V4L2_BUF_FLAG_ERROR:
+                self.requeue(frame)
+                continue
+            if skip > 0:
+                skip -= 1
+                self.requeue(frame)
+                continue
+            return frame
+
+    def capture_to_file(self, path, timeout=FRAME_TIMEOUT, skip=0):
+        """
+        Write the next frame (after dropping `skip` frames) to `path`
+        straight from the mapped buffer.
+        Returns {'path', 'bytes', 'sequence', 'timestamp'}.
+        """
+        frame = self.next_frame(timeout, skip)
+        try:
+            written = write_buffer(path, frame.data)
+            return {'path': path, 'bytes': written, 'sequence': frame.sequence,
+                    'timestamp': frame.timestamp}
+        finally:
+            self.requeue(frame)
+
+    def stack_frames(self, count, timeout=FRAME_TIMEOUT, skip=0, mask=RAW10P_MASK):
+        """
+        Burst: average `count` consecutive frames of 16-bit samples (raw10p,
+        `mask` keeps the significant bits). Every frame is added into a
+        uint32 sum straight from its mapped buffer and requeued at once, so
+        the driver keeps filling the other buffers meanwhile.
+        Returns (rounded mean as uint16 array, same layout as one frame,
+        {'frames', 'sequences', 'timestamps', 'dropped'}).
+        """
+        import numpy as np
+
+        acc = samples = view = None
+        sequences, timestamps = [], []
+        for i in range(count):
+            frame = self.next_frame(timeout, skip if i == 0 else 0)
+            try:
+                view = np.frombuffer(frame.data, dtype='<u2')
+                if acc is None:
+                    acc = np.zeros(view.size, dtype=np.uint32)
+                    samples = np.empty(view.size, dtype=np.uint16)
+                elif view.size != acc.size:
+                    raise V4l2Error("%s: frame size changed during the burst" % self.device)
+                np.bitwise_and(view, mask, out=samples)
+                acc += samples
+                sequences.append(frame.sequence)
+                timestamps.append(frame.timestamp)
+            finally:
+                # drop the export of frame.data first, requeue() releases it
+                view = None
+                self.requeue(frame)
+        acc += count // 2
+        acc //= count
+        np.copyto(samples, acc, casting='unsafe')
+        del acc
+        return samples, {'frames': count, 'sequences': sequences, 'timestamps': timestamps,
+                         'dropped': sequences[-1] - sequences[0] + 1 - count}
+
+    def capture_stack(self, path, count, timeout=FRAME_TIMEOUT, skip=0, mask=RAW10P_MASK):
+        """
+        stack_frames() written to `path`.
+        Returns {'path', 'bytes', 'frames', 'sequences', 'timestamps', 'dropped'}.
+        """
+        samples, info = self.stack_frames(count, timeout, skip, mask)
+        info['bytes'] = write_buffer(path, memoryview(samples).cast('B'))
+        info['path'] = path
+        return info
+
+    def close(self):
+        if self.fd is None:
+            return
+        try:
+            self.stop()
+        finally:
+            os.close(self.fd)
+            self.fd = None
+
+def main():
+    parser = argparse.ArgumentParser(description='Capture one frame with the V4L2 mmap backend.')
+    parser.add_argument('-d', dest='device', default=DEFAULT_DEVICE)
+    parser.add_argument('-W', dest='width', type=int, default=DEFAULT_WIDTH)
+    parser.add_argument('-H', dest='height', type=int, default=DEFAULT_HEIGHT)
+    parser.add_argument('-f', dest='pixfmt', default=DEFAULT_FORMAT, help='fourcc (default: BA10)')
+    parser.add_argument('-n', dest='buffers', type=int, default=DEFAULT_BUFFERS, help='MMAP buffers')
+    parser.add_argument('-b', dest='burst', type=int, default=1,
+                        help='Average this many consecutive frames (16-bit raw formats only)')
+    parser.add_argument('outfile', help='Output raw file')
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    with V4l2Capture(args.device) as cam:
+        w, h, bpl, size = cam.set_format(args.width, args.height, args.pixfmt)
+        print(f"[v] {args.device} ({cam.driver}): {w}x{h} {args.pixfmt}, {bpl} B/line, {size} B")
+        cam.start(args.buffers)
+        if args.burst > 1:
+            info = cam.capture_stack(args.outfile, args.burst)
+            print(f"[v] Burst of {info['frames']} frames #{info['sequences'][0]}-#{info['sequences'][-1]} "
+                  f"({info['dropped']} dropped) over {info['timestamps'][-1] - info['timestamps'][0]:.3f}s")
+        else:
+            info = cam.capture_to_file(args.outfile)
+            print(f"[v] Frame #{info['sequence']} ts={info['timestamp']:.6f}")
+    print(f"[v] {info['bytes']} B -> {info['path']} ({time.perf_counter() - t0:.3f}s)")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())